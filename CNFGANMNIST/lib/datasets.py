@@ -1,4 +1,5 @@
 import os
+import numpy as np
 import torch
 import torchvision
 
@@ -23,6 +24,56 @@ class Dataset(object):
         x = self.transform(x) if self.transform is not None else x
         return x, 0
 
+
+class FastCollate(object):
+    """Collates (image, target) pairs into a uint8 NCHW batch with one vectorized copy.
+
+    Images can be PIL images, HWC or HW uint8 arrays, or uint8 CHW tensors, which are stacked without any
+    conversion. In the main process the batch is written into a ring of num_buffers preallocated (optionally
+    pinned) buffers, so a batch stays valid only until num_buffers - 1 more batches have been collated.
+    Worker processes allocate every batch in shared memory instead, since it is handed to the main process.
+    Give every DataLoader its own instance, so that one loader cannot overwrite the batches of another.
+
+    Deliberately vendored from ffjord-rnode-master-master/lib/datasets.py, since this tree keeps its own lib.
+    """
+
+    def __init__(self, num_buffers=4, pin_memory=False):
+        self.num_buffers = num_buffers
+        self.pin_memory = pin_memory
+        self._buffers = []
+        self._next = 0
+
+    def _buffer(self, shape):
+        if torch.utils.data.get_worker_info() is not None:
+            return torch.empty(shape, dtype=torch.uint8).share_memory_()
+        if self._buffers and (self._buffers[0].shape[1:] != shape[1:] or self._buffers[0].size(0) < shape[0]):
+            self._buffers = []
+        if len(self._buffers) < self.num_buffers:
+            buffer = torch.empty(shape, dtype=torch.uint8)
+            self._buffers.append(buffer.pin_memory() if self.pin_memory else buffer)
+        buffer = self._buffers[self._next % len(self._buffers)]
+        self._next += 1
+        return buffer[:shape[0]]
+
+    def __call__(self, batch):
+        imgs = [img[0] for img in batch]
+        targets = torch.tensor([target[1] for target in batch], dtype=torch.int64)
+
+        if isinstance(imgs[0], torch.Tensor) and imgs[0].dtype == torch.uint8:
+            tensor = self._buffer((len(imgs),) + tuple(imgs[0].shape))
+            torch.stack(imgs, out=tensor)
+            return tensor, targets
+
+        arrays = [np.asarray(img, dtype=np.uint8) for img in imgs]
+        if arrays[0].ndim < 3:
+            arrays = [array[..., None] for array in arrays]
+        h, w, c = arrays[0].shape
+        tensor = self._buffer((len(arrays), c, h, w))
+        # Stack into the NHWC view of the NCHW buffer: the transpose happens inside the single copy.
+        np.stack(arrays, out=tensor.numpy().transpose(0, 2, 3, 1))
+        return tensor, targets
+
+
 # To acquire these datasets, follow instructions in ../preprocessing/
 
 class Imagenet64(torchvision.datasets.ImageFolder):
@@ -24,7 +24,7 @@ from torchvision.utils import save_image
 import lib.layers as layers
 import lib.utils as utils
 import lib.odenvp as odenvp
-from lib.datasets import CelebAHQ, Imagenet64
+from lib.datasets import CelebAHQ, Imagenet64, FastCollate
 
 from train_misc import standard_normal_logprob
 from train_misc import set_cnf_options, count_nfe, count_parameters, count_total_time
@@ -198,31 +198,14 @@ def get_dataset(args):
 
     data_shape = (im_dim, im_size, im_size)
 
-    def fast_collate(batch): ##** 
-
-        imgs = [img[0] for img in batch]
-        targets = torch.tensor([target[1] for target in batch], dtype=torch.int64)
-        w = imgs[0].size[0]
-        h = imgs[0].size[1]
-
-        tensor = torch.zeros( (len(imgs), im_dim, im_size, im_size), dtype=torch.uint8 )
-        for i, img in enumerate(imgs):
-            nump_array = np.asarray(img, dtype=np.uint8)
-            tens = torch.from_numpy(nump_array)
-            if(nump_array.ndim < 3):
-                nump_array = np.expand_dims(nump_array, axis=-1)
-            nump_array = np.rollaxis(nump_array, 2)
-            tensor[i] += torch.from_numpy(nump_array)
-
-        return tensor, targets
-
     train_sampler = (DistributedSampler(train_set,
         num_replicas=env_world_size(), rank=env_rank()) if args.distributed
         else None)
 
     train_loader = torch.utils.data.DataLoader(
         dataset=train_set, batch_size=args.batch_size, #shuffle=True,
-        num_workers=args.nworkers, pin_memory=True, sampler=train_sampler, collate_fn=fast_collate
+        num_workers=args.nworkers, pin_memory=True, sampler=train_sampler,
+        collate_fn=FastCollate(pin_memory=torch.cuda.is_available())
     )
 
     test_sampler = (DistributedSampler(test_set,
@@ -231,7 +214,8 @@ def get_dataset(args):
 
     test_loader = torch.utils.data.DataLoader(
         dataset=test_set, batch_size=args.test_batch_size, #shuffle=False,
-        num_workers=args.nworkers, pin_memory=True, sampler=test_sampler, collate_fn=fast_collate
+        num_workers=args.nworkers, pin_memory=True, sampler=test_sampler,
+        collate_fn=FastCollate(pin_memory=torch.cuda.is_available())
     )
 
     return train_loader, test_loader, data_shape
@@ -34,7 +34,7 @@ import lib.layers as layers
 import lib.utils as utils
 import u_net.utils as unet_utils
 import lib.odenvp as odenvp
-from lib.datasets import CelebAHQ, Imagenet64
+from lib.datasets import CelebAHQ, Imagenet64, FastCollate
 
 from u_net.fid_score import calculate_fid_given_paths_or_tensor
 #import pickle
@@ -137,31 +137,14 @@ def get_dataset(args):
     
     data_shape = (im_dim, im_size, im_size)
 
-    def fast_collate(batch): ##** 
-
-        imgs = [img[0] for img in batch]
-        targets = torch.tensor([target[1] for target in batch], dtype=torch.int64)
-        w = imgs[0].size[0]
-        h = imgs[0].size[1]
-
-        tensor = torch.zeros( (len(imgs), im_dim, im_size, im_size), dtype=torch.uint8 )
-        for i, img in enumerate(imgs):
-            nump_array = np.asarray(img, dtype=np.uint8)
-            tens = torch.from_numpy(nump_array)
-            if(nump_array.ndim < 3):
-                nump_array = np.expand_dims(nump_array, axis=-1)
-            nump_array = np.rollaxis(nump_array, 2)
-            tensor[i] += torch.from_numpy(nump_array)
-
-        return tensor, targets
-
     train_sampler = (DistributedSampler(train_set,
         num_replicas=env_world_size(), rank=env_rank()) if args.distributed
         else None)
 
     train_loader = torch.utils.data.DataLoader(
         dataset=train_set, batch_size=args.batch_size, #shuffle=True,
-        num_workers=args.nworkers, pin_memory=True, sampler=train_sampler, collate_fn=fast_collate
+        num_workers=args.nworkers, pin_memory=True, sampler=train_sampler,
+        collate_fn=FastCollate(pin_memory=torch.cuda.is_available())
     )
 
     test_sampler = (DistributedSampler(test_set,
@@ -170,7 +153,8 @@ def get_dataset(args):
 
     test_loader = torch.utils.data.DataLoader(
         dataset=test_set, batch_size=args.test_batch_size, #shuffle=False,
-        num_workers=args.nworkers, pin_memory=True, sampler=test_sampler, collate_fn=fast_collate
+        num_workers=args.nworkers, pin_memory=True, sampler=test_sampler,
+        collate_fn=FastCollate(pin_memory=torch.cuda.is_available())
     )
 
     return train_loader, test_loader, data_shape
@@ -377,7 +361,8 @@ def run(config,args):
         )
 
         batch_size = config['batch_size']
-        dataset = Celeba(root = root, transform = transform, batch_size = batch_size*config["num_D_accumulations"], imsize = config["resolution"])
+        dataset = Celeba(root = root, transform = transform, batch_size = batch_size*config["num_D_accumulations"], imsize = config["resolution"],
+                         cache_dir = config["image_cache"] or None)
         data_loader = DataLoader(dataset, batch_size, shuffle = True, drop_last = True)
         loaders = [data_loader]
 
@@ -874,7 +859,7 @@ def run(config,args):
                 with torch.no_grad():
                     fig_filename = os.path.join(args.save, "figs", "{:04d}.jpg".format(epoch))
                     utils.makedirs(os.path.dirname(fig_filename))
-                    generated_samples, _, _ = model(fixed_z, reverse=True)
+                    generated_samples, _, _ = model(fixed_z, reverse=True, density=False)
                     generated_samples = generated_samples.view(-1, *data_shape)
                     nb = int(np.ceil(np.sqrt(float(fixed_z.size(0)))))
                     save_image(unshift(generated_samples, nbits=args.nbits), fig_filename, nrow=nb)
@@ -0,0 +1,86 @@
+"""Compares the bits/dim variance per unit of wall-clock of the divergence estimators.
+
+Every estimator evaluates the same test batch `--repeats` times with fresh probe noise. An estimator is
+better when the variance of its bits/dim times its time per evaluation is lower. Hutch++ rounds the budget up
+to a multiple of three, so the "vjps" column reports the products actually used per evaluation.
+
+    python benchmark_divergence.py --chkpt experiments/cnf/best.pth --budgets 1,3,6
+"""
+import argparse
+import time
+import numpy as np
+
+import torch
+
+from lib.layers.odefunc import _hutchpp_rank
+
+from train_misc import standard_normal_logprob, count_nfe
+from train_misc import get_test_set, create_model_from_args
+
+ESTIMATORS = ["approximate", "hutchpp", "hutchpp_cv"]
+
+parser = argparse.ArgumentParser("Divergence estimator benchmark")
+parser.add_argument("--chkpt", type=str, required=True, help='checkpoint saved by train.py or CNFceleb.py')
+parser.add_argument("--datadir", type=str, default="./data/")
+parser.add_argument("--batch_size", type=int, default=16)
+parser.add_argument("--repeats", type=int, default=20)
+parser.add_argument("--estimators", type=str, default=",".join(ESTIMATORS))
+parser.add_argument("--budgets", type=str, default="1,3,6", help='vector-Jacobian products per evaluation')
+parser.add_argument("--seed", type=int, default=0)
+args = parser.parse_args()
+
+
+def get_batch(train_args, batch_size):
+    loader = torch.utils.data.DataLoader(get_test_set(train_args, args.datadir), batch_size=batch_size, shuffle=False)
+    x, _ = next(iter(loader))
+    return x
+
+
+def vjps_per_eval(divergence_fn, budget):
+    if divergence_fn in ("hutchpp", "hutchpp_cv"):
+        return 3 * _hutchpp_rank(budget)
+    return budget
+
+
+def bits_per_dim(x, model, nvals):
+    zero = torch.zeros(x.shape[0], 1).to(x)
+    z, delta_logp, _ = model(x, zero)
+    logpz = standard_normal_logprob(z).view(z.shape[0], -1).sum(1, keepdim=True)
+    logpx = logpz - delta_logp
+    logpx_per_dim = torch.sum(logpx) / x.nelement()
+    return (-(logpx_per_dim - np.log(nvals)) / np.log(2)).item()
+
+
+if __name__ == "__main__":
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    checkpt = torch.load(args.chkpt, map_location=lambda storage, loc: storage)
+    train_args = checkpt["args"]
+    nvals = 2**train_args.nbits
+
+    x = get_batch(train_args, args.batch_size)
+    data_shape = tuple(x.shape[1:])
+    x = (255 * x).round().div(2**(8 - train_args.nbits)).floor().add(0.5).div(nvals).to(device)
+
+    print("{:>12s} {:>7s} {:>5s} {:>10s} {:>10s} {:>8s} {:>10s} {:>12s}".format(
+        "estimator", "budget", "vjps", "bpd", "std", "nfe", "sec/eval", "var*sec"))
+    for divergence_fn in args.estimators.split(","):
+        for budget in map(int, args.budgets.split(",")):
+            model = create_model_from_args(train_args, args.batch_size, data_shape, divergence_fn, budget)
+            model.load_state_dict(checkpt["state_dict"])
+            model.to(device).eval()
+
+            torch.manual_seed(args.seed)
+            bpds, times, nfes = [], [], []
+            with torch.no_grad():
+                for _ in range(args.repeats):
+                    if device.type == "cuda":
+                        torch.cuda.synchronize()
+                    start = time.time()
+                    bpds.append(bits_per_dim(x, model, nvals))
+                    times.append(time.time() - start)
+                    nfes.append(count_nfe(model))
+
+            var, sec = np.var(bpds, ddof=1), np.mean(times)
+            print("{:>12s} {:>7d} {:>5d} {:>10.4f} {:>10.2e} {:>8.1f} {:>10.3f} {:>12.3e}".format(
+                divergence_fn, budget, vjps_per_eval(divergence_fn, budget), np.mean(bpds), np.sqrt(var),
+                np.mean(nfes), sec, var * sec))
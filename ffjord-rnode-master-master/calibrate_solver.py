@@ -0,0 +1,98 @@
+"""Searches per-block test-time solver settings that keep bits/dim within a given error.
+
+Candidates are every adaptive solver at every tolerance and every fixed-grid solver at every step size.
+The result is written as a config that validate.py and train.py load with --cnf_config.
+
+    python calibrate_solver.py --chkpt experiments/cnf/best.pth --max_bpd_error 1e-3
+"""
+import argparse
+import os
+import numpy as np
+
+import torch
+
+import lib.utils as utils
+
+from train_misc import standard_normal_logprob, count_nfe
+from train_misc import get_test_set, create_model_from_args
+from train_misc import calibrate_cnf_config, save_cnf_config
+
+ADAPTIVE = ["dopri5", "bosh3", "adaptive_heun"]
+FIXED = ["rk4", "midpoint", "euler"]
+
+parser = argparse.ArgumentParser("CNF solver calibration")
+parser.add_argument("--chkpt", type=str, required=True, help='checkpoint saved by train.py or CNFceleb.py')
+parser.add_argument("--datadir", type=str, default="./data/")
+parser.add_argument("--batch_size", type=int, default=48)
+parser.add_argument("--num_batches", type=int, default=2, help='validation batches per evaluation')
+parser.add_argument("--max_bpd_error", type=float, default=1e-3)
+parser.add_argument("--solvers", type=str, default="dopri5,bosh3,rk4")
+parser.add_argument("--tols", type=str, default="1e-2,1e-3,1e-4", help='atol = rtol of adaptive candidates')
+parser.add_argument("--step_sizes", type=str, default="1,0.5,0.25", help='step sizes of fixed-grid candidates')
+parser.add_argument("--seed", type=int, default=0)
+parser.add_argument("--output", type=str, default=None, help='defaults to cnf_config.yaml next to the checkpoint')
+args = parser.parse_args()
+
+
+def get_batches(train_args, batch_size, num_batches):
+    loader = torch.utils.data.DataLoader(get_test_set(train_args, args.datadir), batch_size=batch_size, shuffle=False)
+    batches = []
+    for x, _ in loader:
+        batches.append(x)
+        if len(batches) == num_batches:
+            break
+    return batches
+
+
+def candidates():
+    solvers = args.solvers.split(",")
+    out = []
+    for solver in solvers:
+        if solver in FIXED:
+            for step_size in map(float, args.step_sizes.split(",")):
+                out.append({"test_solver": solver, "test_solver_options": {"step_size": step_size}})
+        elif solver in ADAPTIVE:
+            for tol in map(float, args.tols.split(",")):
+                out.append({"test_solver": solver, "test_atol": tol, "test_rtol": tol, "test_solver_options": {}})
+        else:
+            raise ValueError("Unsupported solver {}".format(solver))
+    return out
+
+
+if __name__ == "__main__":
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    checkpt = torch.load(args.chkpt, map_location=lambda storage, loc: storage)
+    train_args = checkpt["args"]
+    nvals = 2**train_args.nbits
+    output = args.output or os.path.join(os.path.dirname(args.chkpt), "cnf_config.yaml")
+    logger = utils.get_logger(logpath=os.path.splitext(output)[0] + ".log", filepath=os.path.abspath(__file__))
+
+    batches = get_batches(train_args, args.batch_size, args.num_batches)
+    data_shape = tuple(batches[0].shape[1:])
+    batches = [(255 * x).round().div(2**(8 - train_args.nbits)).floor().add(0.5).div(nvals).to(device)
+               for x in batches]
+
+    model = create_model_from_args(train_args, args.batch_size, data_shape)
+    model.load_state_dict(checkpt["state_dict"])
+    model.to(device).eval()
+
+    def evaluate(model):
+        bpd, nfe = 0., 0.
+        with torch.no_grad():
+            for x in batches:
+                zero = torch.zeros(x.shape[0], 1).to(x)
+                z, delta_logp, _ = model(x, zero)
+                logpz = standard_normal_logprob(z).view(z.shape[0], -1).sum(1, keepdim=True)
+                logpx_per_dim = torch.sum(logpz - delta_logp) / x.nelement()
+                bpd += (-(logpx_per_dim - np.log(nvals)) / np.log(2)).item() / len(batches)
+                nfe += count_nfe(model)
+        return bpd, nfe
+
+    config, ref_bpd = calibrate_cnf_config(
+        model, evaluate, candidates(), args.max_bpd_error, seed=args.seed, logger=logger
+    )
+    torch.manual_seed(args.seed)
+    bpd, nfe = evaluate(model)
+    logger.info("Calibrated | bpd {:.5f} (reference {:.5f}) | NFE {:.0f}".format(bpd, ref_bpd, nfe))
+    save_cnf_config(output, config, chkpt=args.chkpt, max_bpd_error=args.max_bpd_error, reference_bpd=ref_bpd)
+    logger.info("Saved {}".format(output))
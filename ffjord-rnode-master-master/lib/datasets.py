@@ -1,15 +1,90 @@
 import os
+import struct
+import numpy as np
 import torch
 import torchvision
 
+# Raw uint8 tensors: a 64-byte header (magic, ndim, int64 shape) followed by the data in C order. The data
+# is memory-mapped, so indexing is a zero-copy slice and DataLoader workers share the page cache.
+U8_SUFFIX = '.u8'
+_U8_MAGIC = b'TORCHU8\0'
+_U8_HEADER_SIZE = 64
+
+
+def save_u8(path, data):
+    """Writes a uint8 tensor or array in the .u8 format."""
+    data = np.ascontiguousarray(data.numpy() if isinstance(data, torch.Tensor) else data)
+    if data.dtype != np.uint8:
+        raise ValueError('Expected uint8 data, got {}'.format(data.dtype))
+    with open(path, 'wb') as f:
+        f.write(_u8_header(data.shape))
+        data.tofile(f)
+
+
+def _u8_header(shape):
+    header = _U8_MAGIC + struct.pack('<q', len(shape)) + struct.pack('<{}q'.format(len(shape)), *shape)
+    if len(header) > _U8_HEADER_SIZE:
+        raise ValueError('Too many dimensions for the .u8 header: {}'.format(len(shape)))
+    return header.ljust(_U8_HEADER_SIZE, b'\0')
+
+
+def read_u8_shape(path):
+    with open(path, 'rb') as f:
+        header = f.read(_U8_HEADER_SIZE)
+    if len(header) < _U8_HEADER_SIZE or not header.startswith(_U8_MAGIC):
+        raise ValueError('{} is not a .u8 file'.format(path))
+    ndim, = struct.unpack_from('<q', header, len(_U8_MAGIC))
+    return struct.unpack_from('<{}q'.format(ndim), header, len(_U8_MAGIC) + 8)
+
+
+def create_u8(path, shape):
+    """Creates a .u8 file of the given shape, to be filled through open_u8(path, mode='r+')."""
+    with open(path, 'wb') as f:
+        f.write(_u8_header(shape))
+        f.truncate(_U8_HEADER_SIZE + int(np.prod(shape)))
+
+
+def open_u8(path, mode='c'):
+    """Memory-maps a .u8 file as a uint8 tensor.
+
+    The default copy-on-write mode never modifies the file; use 'r+' to write through to it.
+    """
+    shape = read_u8_shape(path)
+    return torch.from_numpy(np.memmap(path, dtype=np.uint8, mode=mode, offset=_U8_HEADER_SIZE, shape=shape))
+
+
+def convert_to_u8(loc, out=None):
+    """Converts a uint8 tensor saved with torch.save to a .u8 file next to it."""
+    out = out or os.path.splitext(loc)[0] + U8_SUFFIX
+    save_u8(out, torch.load(loc))
+    return out
+
+
 class Dataset(object):
 
     def __init__(self, loc, transform=None, in_mem=True):
+        self.loc = loc
         self.in_mem = in_mem
-        self.dataset = torch.load(loc)
-        if in_mem: self.dataset = self.dataset.float().div(255)
+        self.mmap = loc.endswith(U8_SUFFIX)
+        self._dataset = None
+        if not self.mmap:
+            self._dataset = torch.load(loc)
+        if in_mem: self._dataset = self.dataset.float().div(255)
         self.transform = transform
 
+    @property
+    def dataset(self):
+        # Mapped lazily, so pickling the dataset into DataLoader workers never copies the data.
+        if self._dataset is None:
+            self._dataset = open_u8(self.loc)
+        return self._dataset
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.mmap and not self.in_mem:
+            state['_dataset'] = None
+        return state
+
     def __len__(self):
         return self.dataset.size(0)
 
@@ -23,6 +98,53 @@ class Dataset(object):
         x = self.transform(x) if self.transform is not None else x
         return x, 0
 
+class FastCollate(object):
+    """Collates (image, target) pairs into a uint8 NCHW batch with one vectorized copy.
+
+    Images can be PIL images, HWC or HW uint8 arrays, or uint8 CHW tensors, which are stacked without any
+    conversion. In the main process the batch is written into a ring of num_buffers preallocated (optionally
+    pinned) buffers, so a batch stays valid only until num_buffers - 1 more batches have been collated.
+    Worker processes allocate every batch in shared memory instead, since it is handed to the main process.
+    Give every DataLoader its own instance, so that one loader cannot overwrite the batches of another.
+    """
+
+    def __init__(self, num_buffers=4, pin_memory=False):
+        self.num_buffers = num_buffers
+        self.pin_memory = pin_memory
+        self._buffers = []
+        self._next = 0
+
+    def _buffer(self, shape):
+        if torch.utils.data.get_worker_info() is not None:
+            return torch.empty(shape, dtype=torch.uint8).share_memory_()
+        if self._buffers and (self._buffers[0].shape[1:] != shape[1:] or self._buffers[0].size(0) < shape[0]):
+            self._buffers = []
+        if len(self._buffers) < self.num_buffers:
+            buffer = torch.empty(shape, dtype=torch.uint8)
+            self._buffers.append(buffer.pin_memory() if self.pin_memory else buffer)
+        buffer = self._buffers[self._next % len(self._buffers)]
+        self._next += 1
+        return buffer[:shape[0]]
+
+    def __call__(self, batch):
+        imgs = [img[0] for img in batch]
+        targets = torch.tensor([target[1] for target in batch], dtype=torch.int64)
+
+        if isinstance(imgs[0], torch.Tensor) and imgs[0].dtype == torch.uint8:
+            tensor = self._buffer((len(imgs),) + tuple(imgs[0].shape))
+            torch.stack(imgs, out=tensor)
+            return tensor, targets
+
+        arrays = [np.asarray(img, dtype=np.uint8) for img in imgs]
+        if arrays[0].ndim < 3:
+            arrays = [array[..., None] for array in arrays]
+        h, w, c = arrays[0].shape
+        tensor = self._buffer((len(arrays), c, h, w))
+        # Stack into the NHWC view of the NCHW buffer: the transpose happens inside the single copy.
+        np.stack(arrays, out=tensor.numpy().transpose(0, 2, 3, 1))
+        return tensor, targets
+
+
 # To acquire these datasets, follow instructions in ../preprocessing/
 
 class Imagenet64(torchvision.datasets.ImageFolder):
@@ -38,4 +160,9 @@ class CelebAHQ(Dataset):
     def __init__(self, train=True, transform=None, root='./data/'):
         self.train_loc = os.path.join(root,'celebahq/celeba256_train.pth')
         self.test_loc = os.path.join(root,'celebahq/celeba256_validation.pth')
-        return super(CelebAHQ, self).__init__(self.train_loc if train else self.test_loc, transform=transform, in_mem=False)
+        loc = self.train_loc if train else self.test_loc
+        # Prefer the memory-mapped copy written by preprocessing/convert_to_u8.py.
+        u8_loc = os.path.splitext(loc)[0] + U8_SUFFIX
+        if os.path.exists(u8_loc):
+            loc = u8_loc
+        return super(CelebAHQ, self).__init__(loc, transform=transform, in_mem=False)
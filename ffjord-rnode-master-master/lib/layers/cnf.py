@@ -1,12 +1,23 @@
 import torch
 import torch.nn as nn
 
+import math
+import time
+import warnings
 from torchdiffeq import odeint_adjoint as odeint
+from torchdiffeq import odeint as odeint_direct
 
+from .integrators import odeint_checkpoint, odeint_packed, evals_per_step, CHECKPOINT_SOLVERS, PACKED_SOLVERS
 from .wrappers.cnf_regularization import RegularizedODEfunc
 
 __all__ = ["CNF"]
 
+ADAPTIVE_SOLVERS = ('dopri8', 'dopri5', 'bosh3', 'fehlberg2', 'adaptive_heun')
+
+# Fixed-grid solvers have no accepted/rejected steps, so torchdiffeq warns about the step callbacks of ODEfunc on
+# every such solve, forward and adjoint. Their step counts come from the NFE instead (see CNF._solve).
+warnings.filterwarnings("ignore", message="Solver '.*' does not support callback 'callback_(accept|reject)_step'")
+
 
 class CNF(nn.Module):
     def __init__(self, odefunc, T=1.0, train_T=False, regularization_fns=None, solver='dopri5', atol=1e-5, rtol=1e-5):
@@ -31,50 +42,74 @@ class CNF(nn.Module):
         self.solver_options = {}
         self.test_solver_options = {}
         self.odelayer = True
-        self.density=True
 
-    def forward(self, z, logpz=None, reg_states=tuple(), integration_times=None, reverse=False):
+        # Adaptive step control on z and logp ("z_logp") or on z alone ("z"), never on the reg states.
+        # logp uses logp_atol/logp_rtol when they are set and the solver tolerances otherwise.
+        self.error_control = "z_logp"
+        self.logp_atol = None
+        self.logp_rtol = None
+
+        # Last accepted step size of each (mode, direction), reused as the next initial step.
+        self.warm_start = True
+        self._warm_start_state = {}
+
+        # "adjoint" solves the adjoint ODE backwards, "checkpoint" backpropagates through the solver from
+        # the states at accepted steps, "auto" checkpoints while those states fit in checkpoint_budget bytes.
+        self.integration = "adjoint"
+        self.checkpoint_budget = 2**30
+        self._num_steps = {}
+        # Fixed-grid solves with the adjoint keep (z, logp, *reg_states) in one flat buffer.
+        self.packed_state = False
+        # Synchronize around every solve to report its wall time in solver_stats().
+        self.time_solves = False
 
-        if not len(reg_states)==self.nreg and self.training:
+    def forward(self, z, logpz=None, reg_states=tuple(), integration_times=None, reverse=False, density=True):
+
+        if not len(reg_states)==self.nreg and self.training and density:
             reg_states = tuple(torch.zeros(z.size(0)).to(z) for i in range(self.nreg))
 
-        if logpz is None and self.density:
+        if logpz is None and density:
             _logpz = torch.zeros(z.shape[0], 1).to(z)
         else:
             _logpz = logpz
 
         if integration_times is None:
-            integration_times = torch.tensor([0.0, self.sqrt_end_time * self.sqrt_end_time]).to(z)
+            # Stacked rather than rebuilt with torch.tensor, so that a trainable end time (train_T) gets gradients.
+            end_time = self.sqrt_end_time * self.sqrt_end_time
+            integration_times = torch.stack([torch.zeros_like(end_time), end_time]).to(z)
         if reverse:
             integration_times = _flip(integration_times, 0)
 
 
 
         # Refresh the odefunc statistics.
-        self.odefunc.before_odeint()
+        self.odefunc.before_odeint(direction=-1. if bool(integration_times[-1] < integration_times[0]) else 1.)
+        warm_start_key = ("train" if self.training else "test", reverse)
+        start = self._clock(z)
 
-        if self.density:
+        if density:
             if self.training:
-                state_t = odeint(
-                    self.odefunc,
+                state_t = self._solve(
                     (z, _logpz) + reg_states,
                     integration_times.to(z),
-                    atol=[self.atol, self.atol] + [1e20] * len(reg_states) if self.solver in ['dopri5', 'bosh3'] else self.atol,
-                    rtol=[self.rtol, self.rtol] + [1e20] * len(reg_states) if self.solver in ['dopri5', 'bosh3'] else self.rtol,
+                    atol=self.atol,
+                    rtol=self.rtol,
                     method=self.solver,
                     options=self.solver_options,
+                    key=warm_start_key,
                 )
             else:
-                state_t = odeint(
-                    self.odefunc,
+                state_t = self._solve(
                     (z, _logpz),
                     integration_times.to(z),
                     atol=self.test_atol,
                     rtol=self.test_rtol,
                     method=self.test_solver,
                     options=self.test_solver_options,
+                    key=warm_start_key,
                 )
-            
+
+            self._after_odeint(z, start)
 
             if len(integration_times) == 2:
                 state_t = tuple(s[1] for s in state_t)
@@ -85,37 +120,142 @@ class CNF(nn.Module):
 
             return z_t, logpz_t, reg_states
 
+        # Sampling only: integrate z alone, with the adjoint only if the samples need gradients.
         if self.training:
-            state_t = odeint(
-                self.odefunc,
-                z,
-                integration_times.to(z),
-                atol=self.atol,
-                rtol=self.rtol,
-                method=self.solver,
-                options=self.solver_options,
-            )
+            solver, atol, rtol, options = self.solver, self.atol, self.rtol, self.solver_options
         else:
-            state_t = odeint(
-                self.odefunc,
-                z,
-                integration_times.to(z),
-                atol=self.test_atol,
-                rtol=self.test_rtol,
-                method=self.test_solver,
-                options=self.test_solver_options,
-            )
-        
+            solver, atol, rtol, options = self.test_solver, self.test_atol, self.test_rtol, self.test_solver_options
+        z_t = (odeint if torch.is_grad_enabled() else odeint_direct)(
+            self.odefunc,
+            z,
+            integration_times.to(z),
+            atol=atol,
+            rtol=rtol,
+            method=solver,
+            options=self._warm_start_options(solver, options, warm_start_key),
+        )
+        self._record_warm_start(warm_start_key, solver)
+        self._after_odeint(z, start)
 
         if len(integration_times) == 2:
-            state_t = tuple(s[1] for s in state_t)
+            z_t = z_t[1]
 
-        return state_t
-        
+        return z_t, None, reg_states
 
     def num_evals(self):
         return self.odefunc._num_evals.item()
 
+    def solver_stats(self):
+        """Steps, rejections, step sizes, forward/adjoint NFE and timing of the latest solve."""
+        return self.odefunc.solver_stats()
+
+    def _clock(self, z):
+        if not self.time_solves:
+            return None
+        if z.is_cuda:
+            torch.cuda.synchronize(z.device)
+        return time.time()
+
+    def _after_odeint(self, z, start):
+        self.odefunc.after_odeint(None if start is None else self._clock(z) - start)
+
+    def _warm_start_options(self, solver, options, key):
+        if not self.warm_start or solver not in ADAPTIVE_SOLVERS or key not in self._warm_start_state:
+            return options
+        options = dict(options)
+        options['first_step'] = self._warm_start_state[key]
+        return options
+
+    def _record_warm_start(self, key, method, step=None):
+        # Needs torchdiffeq>=0.2.4, older versions never report accepted steps.
+        if step is None:
+            step = self.odefunc.last_accepted_step()
+        if step is not None:
+            self._warm_start_state[key] = step
+        elif self.warm_start and method in ADAPTIVE_SOLVERS:
+            warnings.warn(
+                "No accepted step was reported by the {} solve, so warm start is inactive. The step callbacks "
+                "need torchdiffeq>=0.2.4.".format(method)
+            )
+
+    def _error_control(self, num_states, atol, rtol, method, options):
+        # Per-state tolerances only apply to the forward solve of an adaptive solver; fixed-grid solvers
+        # ignore them and the adjoint solve has a differently sized augmented state.
+        if method not in ADAPTIVE_SOLVERS:
+            return atol, rtol, options
+        atol = [atol, atol if self.logp_atol is None else self.logp_atol] + [atol] * (num_states - 2)
+        rtol = [rtol, rtol if self.logp_rtol is None else self.logp_rtol] + [rtol] * (num_states - 2)
+        options = dict(options)
+        options['norm'] = _StateNorm(1 if self.error_control == "z" else 2)
+        return atol, rtol, options
+
+    def _solve(self, state, integration_times, atol, rtol, method, options, key):
+        options = self._warm_start_options(method, options, key)
+        adjoint_atol, adjoint_rtol = atol, rtol
+        atol, rtol, options = self._error_control(len(state), atol, rtol, method, options)
+        if self._use_checkpoint(state, integration_times, method, options, key):
+            info = {}
+            state_t = odeint_checkpoint(
+                self.odefunc, state, integration_times, atol=atol, rtol=rtol, method=method, options=options,
+                info=info
+            )
+            self._num_steps[key] = info["num_steps"]
+            self._record_warm_start(key, method, info["next_step"] if method in ADAPTIVE_SOLVERS else None)
+        elif self._use_packed(integration_times, method, options):
+            state_t = odeint_packed(self.odefunc, state, integration_times, method=method, options=options)
+        else:
+            state_t = odeint(
+                self.odefunc, state, integration_times, atol=atol, rtol=rtol, method=method, options=options,
+                adjoint_atol=adjoint_atol, adjoint_rtol=adjoint_rtol
+            )
+            if self.integration == "auto" and method in CHECKPOINT_SOLVERS:
+                self._num_steps[key] = math.ceil(self.odefunc._num_evals.item() / evals_per_step(method))
+            self._record_warm_start(key, method)
+        return state_t
+
+    def _use_checkpoint(self, state, integration_times, method, options, key):
+        if self.integration == "adjoint" or not torch.is_grad_enabled() or method not in CHECKPOINT_SOLVERS:
+            return False
+        if integration_times.requires_grad:
+            # A trainable end time (train_T) needs the adjoint: odeint_checkpoint cannot differentiate t.
+            return False
+        if self.integration == "checkpoint":
+            return True
+        if method in ADAPTIVE_SOLVERS:
+            # Unknown until one solve of this (mode, direction) has run with the adjoint.
+            if key not in self._num_steps:
+                return False
+            num_steps = self._num_steps[key]
+        else:
+            if options.get('step_size') is None:
+                return False
+            span = abs(integration_times[-1] - integration_times[0]).item()
+            num_steps = math.ceil(span / options['step_size'])
+        state_bytes = sum(s.numel() * s.element_size() for s in state)
+        return state_bytes * (num_steps + 1) <= self.checkpoint_budget
+
+    def _use_packed(self, integration_times, method, options):
+        # Like odeint_checkpoint, odeint_packed cannot differentiate a trainable end time (train_T),
+        # so such solves keep the adjoint.
+        return (
+            self.packed_state and method in PACKED_SOLVERS and options.get('step_size') is not None
+            and not integration_times.requires_grad
+        )
+
+    def warm_start_state(self):
+        """Returns {(mode, reverse): last accepted step size} of the latest solves."""
+        return {k: float(step) for k, step in self._warm_start_state.items()}
+
+
+class _StateNorm(object):
+    """RMS norm of each of the first num_controlled state tensors, maximised over them."""
+
+    def __init__(self, num_controlled):
+        self.num_controlled = num_controlled
+
+    def __call__(self, tensors):
+        return torch.stack([tensor.pow(2).mean().sqrt() for tensor in tensors[:self.num_controlled]]).max()
+
 
 def _flip(x, dim):
     indices = [slice(None)] * x.dim()
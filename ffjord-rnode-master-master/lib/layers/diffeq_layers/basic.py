@@ -1,7 +1,19 @@
+from collections import OrderedDict
+import weakref
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+try:
+    import torch.autograd.forward_ad as fwAD
+except ImportError:
+    fwAD = None
+
+# Distinct times remembered per layer. Fixed-grid solvers revisit the same few times at every iteration,
+# adaptive solvers mostly do not, so a small bound is enough.
+TIME_CACHE_SIZE = 64
+
 
 def weights_init(m):
     classname = m.__class__.__name__
@@ -10,6 +22,89 @@ def weights_init(m):
         nn.init.normal_(m.bias, 0, 0.01)
 
 
+_last_time = (None, None, None)
+
+
+def _time_value(t):
+    # All layers of one evaluation see the same t, so its value is read from the device once per evaluation
+    # instead of once per layer. Only a weak reference is kept, so t is freed with the solve that made it.
+    global _last_time
+    last_ref, version, value = _last_time
+    if last_ref is None or last_ref() is not t or version != t._version:
+        value = t.item()
+        _last_time = (weakref.ref(t), t._version, value)
+    return value
+
+
+def _is_dual(t):
+    return fwAD is not None and fwAD.unpack_dual(t).tangent is not None
+
+
+class _TimeConditioned(torch.autograd.Function):
+    """Returns a cached value of fn(t), recomputing fn in backward to get the gradients of t and params."""
+
+    @staticmethod
+    def forward(ctx, fn, value, t, *params):
+        ctx.fn = fn
+        ctx.save_for_backward(t, *params)
+        return value
+
+    @staticmethod
+    def backward(ctx, grad_value):
+        inputs = ctx.saved_tensors
+        wrt = [x for x, needs_grad in zip(inputs, ctx.needs_input_grad[2:]) if needs_grad]
+        create_graph = torch.is_grad_enabled()
+        with torch.enable_grad():
+            value = ctx.fn(inputs[0])
+        grads = iter(torch.autograd.grad(value, wrt, grad_value, allow_unused=True, create_graph=create_graph))
+        return (None, None) + tuple(next(grads) if needs_grad else None for needs_grad in ctx.needs_input_grad[2:])
+
+
+class TimeCache(object):
+    """Per-layer cache of time-conditioned weights and gates.
+
+    Values are keyed on the value, dtype and device of t and dropped as soon as the parameters that produced
+    them change, e.g. after an optimizer step. When a graph is needed, the cached value is returned through
+    _TimeConditioned, so the forward pass skips the network and only the backward pass re-evaluates it.
+    Set max_size to 0 to disable.
+    """
+
+    def __init__(self, max_size=TIME_CACHE_SIZE):
+        self.max_size = max_size
+        self._values = OrderedDict()
+        self._params_keys = {}
+
+    def clear(self):
+        self._values.clear()
+        self._params_keys.clear()
+
+    def __call__(self, name, fn, t, params):
+        if self.max_size <= 0 or _is_dual(t):
+            return fn(t)
+        params = tuple(params)
+
+        params_key = tuple((p.data_ptr(), p._version) for p in params)
+        if self._params_keys.get(name) != params_key:
+            for key in [key for key in self._values if key[0] == name]:
+                del self._values[key]
+            self._params_keys[name] = params_key
+
+        key = (name, _time_value(t), t.dtype, t.device)
+        value = self._values.get(key)
+        if value is None:
+            with torch.no_grad():
+                value = fn(t.detach())
+            self._values[key] = value
+            if len(self._values) > self.max_size:
+                self._values.popitem(last=False)
+        else:
+            self._values.move_to_end(key)
+
+        if torch.is_grad_enabled() and (t.requires_grad or any(p.requires_grad for p in params)):
+            return _TimeConditioned.apply(fn, value, t, *params)
+        return value
+
+
 class HyperLinear(nn.Module):
     def __init__(self, dim_in, dim_out, hypernet_dim=8, n_hidden=1, activation=nn.Tanh):
         super(HyperLinear, self).__init__()
@@ -25,9 +120,13 @@ class HyperLinear(nn.Module):
                 layers.append(activation())
         self._hypernet = nn.Sequential(*layers)
         self._hypernet.apply(weights_init)
+        self._time_cache = TimeCache()
+
+    def _params(self, t):
+        return self._hypernet(t.view(1, 1)).view(-1)
 
     def forward(self, t, x):
-        params = self._hypernet(t.view(1, 1)).view(-1)
+        params = self._time_cache("params", self._params, t, self._hypernet.parameters())
         b = params[:self.dim_out].view(self.dim_out)
         w = params[self.dim_out:].view(self.dim_out, self.dim_in)
         return F.linear(x, w, b)
@@ -69,9 +168,13 @@ class SquashLinear(nn.Module):
         super(SquashLinear, self).__init__()
         self._layer = nn.Linear(dim_in, dim_out)
         self._hyper = nn.Linear(1, dim_out)
+        self._time_cache = TimeCache()
+
+    def _gate(self, t):
+        return torch.sigmoid(self._hyper(t.view(1, 1)))
 
     def forward(self, t, x):
-        return self._layer(x) * torch.sigmoid(self._hyper(t.view(1, 1)))
+        return self._layer(x) * self._time_cache("gate", self._gate, t, self._hyper.parameters())
 
 
 class ConcatSquashLinear(nn.Module):
@@ -80,10 +183,18 @@ class ConcatSquashLinear(nn.Module):
         self._layer = nn.Linear(dim_in, dim_out)
         self._hyper_bias = nn.Linear(1, dim_out, bias=False)
         self._hyper_gate = nn.Linear(1, dim_out)
+        self._time_cache = TimeCache()
+
+    def _gate(self, t):
+        return torch.sigmoid(self._hyper_gate(t.view(1, 1)))
+
+    def _bias(self, t):
+        return self._hyper_bias(t.view(1, 1))
 
     def forward(self, t, x):
-        return self._layer(x) * torch.sigmoid(self._hyper_gate(t.view(1, 1))) \
-            + self._hyper_bias(t.view(1, 1))
+        gate = self._time_cache("gate", self._gate, t, self._hyper_gate.parameters())
+        bias = self._time_cache("bias", self._bias, t, self._hyper_bias.parameters())
+        return self._layer(x) * gate + bias
 
 
 class HyperConv2d(nn.Module):
@@ -107,9 +218,13 @@ class HyperConv2d(nn.Module):
         self.conv_fn = F.conv_transpose2d if transpose else F.conv2d
 
         self._hypernet.apply(weights_init)
+        self._time_cache = TimeCache()
+
+    def _params(self, t):
+        return self._hypernet(t.view(1, 1)).view(-1)
 
     def forward(self, t, x):
-        params = self._hypernet(t.view(1, 1)).view(-1)
+        params = self._time_cache("params", self._params, t, self._hypernet.parameters())
         weight_size = int(self.dim_in * self.dim_out * self.ksize * self.ksize / self.groups)
         if self.transpose:
             weight = params[:weight_size].view(self.dim_in, self.dim_out // self.groups, self.ksize, self.ksize)
@@ -145,9 +260,29 @@ class SquashConv2d(nn.Module):
             bias=bias
         )
         self._hyper = nn.Linear(1, dim_out)
+        self._time_cache = TimeCache()
+
+    def _gate(self, t):
+        return torch.sigmoid(self._hyper(t.view(1, 1))).view(1, -1, 1, 1)
 
     def forward(self, t, x):
-        return self._layer(x) * torch.sigmoid(self._hyper(t.view(1, 1))).view(1, -1, 1, 1)
+        return self._layer(x) * self._time_cache("gate", self._gate, t, self._hyper.parameters())
+
+
+def _input_channels(layer, start, stop):
+    """The slice of a conv layer's weight that acts on input channels start:stop."""
+    if layer.transposed:
+        return layer.weight[start:stop]
+    return layer.weight[:, start:stop]
+
+
+def _conv(layer, x, weight, bias):
+    """Applies a conv layer's hyperparameters with another weight and bias."""
+    if layer.transposed:
+        return F.conv_transpose2d(
+            x, weight, bias, layer.stride, layer.padding, layer.output_padding, layer.groups, layer.dilation
+        )
+    return F.conv2d(x, weight, bias, layer.stride, layer.padding, layer.dilation, layer.groups)
 
 
 class ConcatConv2d(nn.Module):
@@ -159,12 +294,35 @@ class ConcatConv2d(nn.Module):
             bias=bias
         )
         #self._layer.weight.data.zero_()
+        # The time channel is split out of the weight instead of concatenated to x. Grouped convs keep the
+        # concatenation, since the time channel only feeds the first group.
+        self.fused = groups == 1
+        self._time_map_key = None
+        self._time_map_value = None
+
+    def _time_map(self, x):
+        """Response of the time channel to a constant image of ones, zero padding included."""
+        weight = self._layer.weight
+        if torch.is_grad_enabled() and weight.requires_grad:
+            return _conv(self._layer, x.new_ones(1, 1, *x.shape[2:]), _input_channels(self._layer, 0, 1), None)
+        key = (tuple(x.shape[2:]), x.dtype, x.device, weight.data_ptr(), weight._version)
+        if self._time_map_key != key:
+            with torch.no_grad():
+                self._time_map_value = _conv(
+                    self._layer, x.new_ones(1, 1, *x.shape[2:]), _input_channels(self._layer, 0, 1), None
+                )
+            self._time_map_key = key
+        return self._time_map_value
 
     def forward(self, t, x):
-        sh = x.shape
-        tt = t.expand(sh[0],1,*sh[2:])
-        ttx = torch.cat([tt, x], 1)
-        return self._layer(ttx)
+        if not self.fused:
+            sh = x.shape
+            tt = t.expand(sh[0],1,*sh[2:])
+            ttx = torch.cat([tt, x], 1)
+            return self._layer(ttx)
+        # conv([t, x]) = conv(x) + t * conv([1]), by linearity.
+        out = _conv(self._layer, x, _input_channels(self._layer, 1, None), self._layer.bias)
+        return out + t.view(1, 1, 1, 1).to(out) * self._time_map(x)
 
 
 class ConcatConv2d_v2(nn.Module):
@@ -191,10 +349,18 @@ class ConcatSquashConv2d(nn.Module):
         )
         self._hyper_gate = nn.Linear(1, dim_out)
         self._hyper_bias = nn.Linear(1, dim_out, bias=False)
+        self._time_cache = TimeCache()
+
+    def _gate(self, t):
+        return torch.sigmoid(self._hyper_gate(t.view(1, 1))).view(1, -1, 1, 1)
+
+    def _bias(self, t):
+        return self._hyper_bias(t.view(1, 1)).view(1, -1, 1, 1)
 
     def forward(self, t, x):
-        return self._layer(x) * torch.sigmoid(self._hyper_gate(t.view(1, 1))).view(1, -1, 1, 1) \
-            + self._hyper_bias(t.view(1, 1)).view(1, -1, 1, 1)
+        gate = self._time_cache("gate", self._gate, t, self._hyper_gate.parameters())
+        bias = self._time_cache("bias", self._bias, t, self._hyper_bias.parameters())
+        return self._layer(x) * gate + bias
 
 
 class ConcatCoordConv2d(nn.Module):
@@ -205,14 +371,51 @@ class ConcatCoordConv2d(nn.Module):
             dim_in + 3, dim_out, kernel_size=ksize, stride=stride, padding=padding, dilation=dilation, groups=groups,
             bias=bias
         )
+        self.dim_in = dim_in
+        # As in ConcatConv2d, the constant channels are split out of the weight. Grouped convs keep the
+        # concatenation.
+        self.fused = groups == 1
+        self._grids = {}
+        self._maps_key = None
+        self._maps_value = None
+
+    def _grid(self, x):
+        """The constant channels as a batch of two images: [1, 0, 0] for the time and [0, h, w] for the coordinates."""
+        h, w = x.shape[2:]
+        key = (h, w, x.dtype, x.device)
+        grid = self._grids.get(key)
+        if grid is None:
+            grid = self._grids[key] = torch.zeros(2, 3, h, w, dtype=x.dtype, device=x.device)
+            grid[0, 0] = 1
+            grid[1, 1] = torch.arange(h, dtype=x.dtype, device=x.device).view(h, 1)
+            grid[1, 2] = torch.arange(w, dtype=x.dtype, device=x.device).view(1, w)
+        return grid
+
+    def _maps(self, x):
+        """Responses of the time and coordinate channels, stacked along the batch dimension."""
+        weight = self._layer.weight
+        if torch.is_grad_enabled() and weight.requires_grad:
+            return _conv(self._layer, self._grid(x), _input_channels(self._layer, self.dim_in, None), None)
+        key = (tuple(x.shape[2:]), x.dtype, x.device, weight.data_ptr(), weight._version)
+        if self._maps_key != key:
+            with torch.no_grad():
+                self._maps_value = _conv(
+                    self._layer, self._grid(x), _input_channels(self._layer, self.dim_in, None), None
+                )
+            self._maps_key = key
+        return self._maps_value
 
     def forward(self, t, x):
-        b, c, h, w = x.shape
-        hh = torch.arange(h).to(x).view(1, 1, h, 1).expand(b, 1, h, w)
-        ww = torch.arange(w).to(x).view(1, 1, 1, w).expand(b, 1, h, w)
-        tt = t.to(x).view(1, 1, 1, 1).expand(b, 1, h, w)
-        x_aug = torch.cat([x, tt, hh, ww], 1)
-        return self._layer(x_aug)
+        if not self.fused:
+            b, c, h, w = x.shape
+            hh = torch.arange(h).to(x).view(1, 1, h, 1).expand(b, 1, h, w)
+            ww = torch.arange(w).to(x).view(1, 1, 1, w).expand(b, 1, h, w)
+            tt = t.to(x).view(1, 1, 1, 1).expand(b, 1, h, w)
+            x_aug = torch.cat([x, tt, hh, ww], 1)
+            return self._layer(x_aug)
+        out = _conv(self._layer, x, _input_channels(self._layer, 0, self.dim_in), self._layer.bias)
+        maps = self._maps(x)
+        return out + t.view(1, 1, 1, 1).to(out) * maps[:1] + maps[1:]
 
 
 class GatedLinear(nn.Module):
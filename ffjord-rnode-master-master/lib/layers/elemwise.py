@@ -1,6 +1,7 @@
 import math
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 _DEFAULT_ALPHA = 1e-6
 
@@ -10,17 +11,16 @@ class ZeroMeanTransform(nn.Module):
         nn.Module.__init__(self)
         self.odelayer=False
 
-    def forward(self, x, logpx=None, reg_states=tuple(), reverse=False):
+    def forward(self, x, logpx=None, reg_states=tuple(), reverse=False, density=True):
         if reverse:
             x = x + .5
-            if logpx is None:
-                return x
-            return x, logpx, reg_states
         else:
             x = x - .5
-            if logpx is None:
-                return x
-            return x, logpx, reg_states
+        if not density:
+            return x, None, reg_states
+        if logpx is None:
+            return x
+        return x, logpx, reg_states
 
 
 class LogitTransform(nn.Module):
@@ -35,7 +35,9 @@ class LogitTransform(nn.Module):
         self.alpha = alpha
         self.odelayer=False
 
-    def forward(self, x, logpx=None, reg_states=tuple(), reverse=False):
+    def forward(self, x, logpx=None, reg_states=tuple(), reverse=False, density=True):
+        if not density:
+            return (_sigmoid(x, None, self.alpha) if reverse else _logit(x, None, self.alpha)), None, reg_states
         if reverse:
             out = _sigmoid(x, logpx, self.alpha)
             return out[0], out[1], reg_states
@@ -52,7 +54,9 @@ class SigmoidTransform(nn.Module):
         self.alpha = alpha
         self.odelayer=False
 
-    def forward(self, x, logpx=None, reg_states=tuple(), reverse=False):
+    def forward(self, x, logpx=None, reg_states=tuple(), reverse=False, density=True):
+        if not density:
+            return (_logit(x, None, self.alpha) if reverse else _sigmoid(x, None, self.alpha)), None, reg_states
         if reverse:
             out = _logit(x, logpx, self.alpha)
             return out[0], out[1], reg_states
@@ -62,21 +66,31 @@ class SigmoidTransform(nn.Module):
 
 
 def _logit(x, logpx=None, alpha=_DEFAULT_ALPHA):
-    s = alpha + (1 - 2 * alpha) * x
-    y = torch.log(s) - torch.log(1 - s)
+    if torch.is_grad_enabled():
+        y = torch.logit(alpha + (1 - 2 * alpha) * x)
+    else:
+        # Evaluation: one buffer, transformed in place.
+        y = x.mul(1 - 2 * alpha).add_(alpha).logit_()
     if logpx is None:
         return y
-    return y, logpx - _logdetgrad(x, alpha).view(x.size(0), -1).sum(1, keepdim=True)
+    return y, logpx - _logdetgrad(y, alpha)
 
 
 def _sigmoid(y, logpy=None, alpha=_DEFAULT_ALPHA):
-    x = (torch.sigmoid(y) - alpha) / (1 - 2 * alpha)
+    if torch.is_grad_enabled():
+        x = (torch.sigmoid(y) - alpha) / (1 - 2 * alpha)
+    else:
+        x = torch.sigmoid(y).sub_(alpha).div_(1 - 2 * alpha)
     if logpy is None:
         return x
-    return x, logpy + _logdetgrad(x, alpha).view(x.size(0), -1).sum(1, keepdim=True)
+    return x, logpy + _logdetgrad(y, alpha)
 
 
-def _logdetgrad(x, alpha):
-    s = alpha + (1 - 2 * alpha) * x
-    logdetgrad = -torch.log(s - s * s) + math.log(1 - 2 * alpha)
-    return logdetgrad
+def _logdetgrad(y, alpha):
+    """Per-sample log |dy/dx| of the logit transform, in terms of its output y = logit(s).
+
+    -log(s - s*s) = softplus(y) + softplus(-y) = 2 * softplus(y) - y, so neither s nor log(s) is recomputed.
+    """
+    y = y.reshape(y.size(0), -1)
+    logdetgrad = 2 * F.softplus(y).sum(1, keepdim=True) - y.sum(1, keepdim=True)
+    return logdetgrad + y.size(1) * math.log(1 - 2 * alpha)
@@ -0,0 +1,410 @@
+import collections
+import torch
+
+__all__ = ["odeint_checkpoint", "odeint_packed", "CHECKPOINT_SOLVERS", "PACKED_SOLVERS", "evals_per_step"]
+
+_ButcherTableau = collections.namedtuple("_ButcherTableau", "c a b b_error order")
+
+# Same tableaus as torchdiffeq, so step counts match the adjoint path.
+_TABLEAUS = {
+    "dopri5": _ButcherTableau(
+        c=(1 / 5, 3 / 10, 4 / 5, 8 / 9, 1., 1.),
+        a=(
+            (1 / 5,),
+            (3 / 40, 9 / 40),
+            (44 / 45, -56 / 15, 32 / 9),
+            (19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729),
+            (9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656),
+            (35 / 384, 0., 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84),
+        ),
+        b=(35 / 384, 0., 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84, 0.),
+        b_error=(
+            35 / 384 - 1951 / 21600, 0., 500 / 1113 - 22642 / 50085, 125 / 192 - 451 / 720,
+            -2187 / 6784 + 12231 / 42400, 11 / 84 - 649 / 6300, -1. / 60.
+        ),
+        order=5,
+    ),
+    "bosh3": _ButcherTableau(
+        c=(1 / 2, 3 / 4, 1.),
+        a=((1 / 2,), (0., 3 / 4), (2 / 9, 1 / 3, 4 / 9)),
+        b=(2 / 9, 1 / 3, 4 / 9, 0.),
+        b_error=(2 / 9 - 7 / 24, 1 / 3 - 1 / 4, 4 / 9 - 1 / 3, -1 / 8),
+        order=3,
+    ),
+    "adaptive_heun": _ButcherTableau(c=(1.,), a=((1.,),), b=(1 / 2, 1 / 2), b_error=(1 / 2, -1 / 2), order=2),
+    "euler": _ButcherTableau(c=(), a=(), b=(1.,), b_error=None, order=1),
+    "midpoint": _ButcherTableau(c=(1 / 2,), a=((1 / 2,),), b=(0., 1.), b_error=None, order=2),
+    # torchdiffeq's "rk4" is the 3/8 rule.
+    "rk4": _ButcherTableau(
+        c=(1 / 3, 2 / 3, 1.),
+        a=((1 / 3,), (-1 / 3, 1.), (1., -1., 1.)),
+        b=(1 / 8, 3 / 8, 3 / 8, 1 / 8),
+        b_error=None,
+        order=4,
+    ),
+}
+
+CHECKPOINT_SOLVERS = tuple(_TABLEAUS.keys())
+PACKED_SOLVERS = tuple(method for method, tableau in _TABLEAUS.items() if tableau.b_error is None)
+
+
+def _is_fsal(tableau):
+    # First same as last: the final stage is evaluated at the solution of the step.
+    return len(tableau.a) > 0 and tableau.c[-1] == 1. and tuple(tableau.a[-1]) == tuple(tableau.b[:-1]) \
+        and tableau.b[-1] == 0.
+
+
+def evals_per_step(method):
+    """Number of function evaluations of one accepted step of `method`."""
+    tableau = _TABLEAUS[method]
+    return len(tableau.b) - 1 if _is_fsal(tableau) else len(tableau.b)
+
+
+def _time(value, like):
+    return torch.full((), value, dtype=like.dtype, device=like.device)
+
+
+def _combine(y0, dt, coeffs, k):
+    """Returns y0 + dt * sum_j coeffs[j] * k[j] for every tensor of the state (or without y0 if None)."""
+    out = []
+    for n in range(len(k[0])):
+        acc = sum(coeff * k_j[n] for coeff, k_j in zip(coeffs, k) if coeff != 0.)
+        out.append(dt * acc if y0 is None else y0[n] + dt * acc)
+    return tuple(out)
+
+
+def _rk_step(func, t0, y0, f0, dt, tableau, with_error=True):
+    """Takes one explicit Runge-Kutta step of size dt.
+
+    Returns (y1, f1, y1_error). f1 is func(t1, y1) for FSAL methods and None otherwise, y1_error is None
+    unless requested. Without the error estimate the last stage of FSAL methods is skipped.
+    """
+    fsal = _is_fsal(tableau)
+    k = [f0]
+    y1 = None
+    for i, (c_i, a_i) in enumerate(zip(tableau.c, tableau.a)):
+        yi = _combine(y0, dt, a_i, k)
+        if fsal and i == len(tableau.a) - 1:
+            y1 = yi
+            if not with_error:
+                return y1, None, None
+        k.append(func(t0 + c_i * dt, yi))
+    if y1 is None:
+        y1 = _combine(y0, dt, tableau.b, k)
+    f1 = k[-1] if fsal else None
+    y1_error = _combine(None, dt, tableau.b_error, k) if with_error and tableau.b_error is not None else None
+    return y1, f1, y1_error
+
+
+def _scaled_rms(xs, ys, atol, rtol, norm=None):
+    """Max over the state tensors of the RMS of x / (atol + rtol * |y|), as torchdiffeq's mixed norm.
+
+    A custom norm gets the tuple of scaled tensors, like torchdiffeq's norm option.
+    """
+    if norm is not None:
+        return float(norm(tuple(x / (atol_ + rtol_ * y.abs()) for x, y, atol_, rtol_ in zip(xs, ys, atol, rtol))))
+    return torch.stack([
+        (x / (atol_ + rtol_ * y.abs())).pow(2).mean().sqrt() for x, y, atol_, rtol_ in zip(xs, ys, atol, rtol)
+    ]).max().item()
+
+
+def _error_ratio(y1_error, y0, y1, atol, rtol, norm=None):
+    y_max = tuple(torch.max(y0_.abs(), y1_.abs()) for y0_, y1_ in zip(y0, y1))
+    return _scaled_rms(y1_error, y_max, atol, rtol, norm)
+
+
+def _select_initial_step(func, t0, y0, f0, direction, tableau, atol, rtol, norm=None):
+    """Hairer's initial step size heuristic, costs one function evaluation."""
+    d0 = _scaled_rms(y0, y0, atol, rtol, norm)
+    d1 = _scaled_rms(f0, y0, atol, rtol, norm)
+    h0 = 1e-6 if d0 < 1e-5 or d1 < 1e-5 else 0.01 * d0 / d1
+
+    y1 = _combine(y0, direction * h0, (1.,), [f0])
+    f1 = func(t0 + direction * h0, y1)
+    d2 = _scaled_rms(tuple(f1_ - f0_ for f1_, f0_ in zip(f1, f0)), y0, atol, rtol, norm) / h0
+
+    if d1 <= 1e-15 and d2 <= 1e-15:
+        h1 = max(1e-6, h0 * 1e-3)
+    else:
+        h1 = (0.01 / max(d1, d2))**(1. / (tableau.order + 1))
+    return min(100 * h0, h1)
+
+
+def _optimal_step_size(last_step, error_ratio, order, safety=0.9, ifactor=10.0, dfactor=0.2):
+    if error_ratio == 0:
+        return last_step * ifactor
+    if error_ratio < 1:
+        dfactor = 1.0
+    factor = min(ifactor, max(safety / error_ratio**(1. / order), dfactor))
+    return last_step * factor
+
+
+def _integrate(func, y0, t, tableau, atol, rtol, options, checkpoints=None):
+    """Integrates func from t[0] through every time in t.
+
+    Returns the solutions at t and the step size proposed for the next step. The (t0, dt, y0) of every
+    accepted step of the interval [t[i], t[i + 1]] are appended to checkpoints[i] when given.
+    """
+    adaptive = tableau.b_error is not None
+    ts = t.tolist()
+    direction = 1. if ts[-1] >= ts[0] else -1.
+    accept_step = getattr(func, "callback_accept_step", None)
+    reject_step = getattr(func, "callback_reject_step", None)
+    max_num_steps = options.get("max_num_steps", 2**31 - 1)
+    norm = options.get("norm")
+
+    t_cur, y = ts[0], y0
+    f0 = func(_time(t_cur, y[0]), y)
+    if adaptive:
+        if options.get("first_step") is not None:
+            step = abs(float(options["first_step"]))
+        else:
+            step = _select_initial_step(func, _time(t_cur, y[0]), y, f0, direction, tableau, atol, rtol, norm)
+    else:
+        if options.get("step_size") is None:
+            raise ValueError("Fixed-grid solvers need options['step_size'].")
+        step = abs(float(options["step_size"]))
+
+    solution = [y0]
+    num_steps = 0
+    for i, t1 in enumerate(ts[1:]):
+        steps = [] if checkpoints is not None else None
+        while (t1 - t_cur) * direction > 0:
+            if num_steps >= max_num_steps:
+                raise RuntimeError("max_num_steps exceeded ({})".format(max_num_steps))
+            if f0 is None:
+                f0 = func(_time(t_cur, y[0]), y)
+
+            # Land exactly on the output times instead of interpolating, so the backward pass only
+            # ever recomputes whole steps.
+            clipped = step >= abs(t1 - t_cur)
+            dt = t1 - t_cur if clipped else direction * step
+            y1, f1, y1_error = _rk_step(func, _time(t_cur, y[0]), y, f0, dt, tableau, with_error=adaptive)
+            num_steps += 1
+
+            if adaptive:
+                error_ratio = _error_ratio(y1_error, y, y1, atol, rtol, norm)
+                accepted = error_ratio <= 1
+                next_step = _optimal_step_size(abs(dt), error_ratio, tableau.order)
+                step = max(step, next_step) if clipped and accepted else next_step
+            else:
+                accepted = True
+
+            if not accepted:
+                if reject_step is not None:
+                    reject_step(_time(t_cur, y[0]), y, _time(dt, y[0]))
+                continue
+
+            if steps is not None:
+                steps.append((t_cur, dt, y))
+            if accept_step is not None:
+                accept_step(_time(t_cur, y[0]), y, _time(dt, y[0]))
+            t_cur, y, f0 = t1 if clipped else t_cur + dt, y1, f1
+        if checkpoints is not None:
+            checkpoints.append(steps)
+        solution.append(y)
+
+    solution = tuple(torch.stack([y_t[n] for y_t in solution]) for n in range(len(y0)))
+    return solution, step
+
+
+class _CheckpointedOdeint(torch.autograd.Function):
+
+    @staticmethod
+    def forward(ctx, func, method, t, atol, rtol, options, info, n_states, *args):
+        y0, params = args[:n_states], args[n_states:]
+        ctx.func, ctx.method, ctx.n_states = func, method, n_states
+
+        ctx.checkpoints = []
+        with torch.no_grad():
+            solution, next_step = _integrate(func, y0, t, _TABLEAUS[method], atol, rtol, options, ctx.checkpoints)
+        info["next_step"] = next_step
+        info["num_steps"] = sum(len(steps) for steps in ctx.checkpoints)
+
+        ctx.save_for_backward(*params)
+        return solution
+
+    @staticmethod
+    def backward(ctx, *grad_solution):
+        func, tableau, n_states = ctx.func, _TABLEAUS[ctx.method], ctx.n_states
+        params = ctx.saved_tensors
+
+        adj_y = tuple(g[-1] for g in grad_solution)
+        adj_params = [torch.zeros_like(p) for p in params]
+        for i in range(len(ctx.checkpoints) - 1, -1, -1):
+            for t0, dt, y0 in reversed(ctx.checkpoints[i]):
+                with torch.enable_grad():
+                    y0 = tuple(y0_.detach().requires_grad_(True) for y0_ in y0)
+                    t0 = _time(t0, y0[0])
+                    y1, _, _ = _rk_step(func, t0, y0, func(t0, y0), dt, tableau, with_error=False)
+                    vjps = torch.autograd.grad(y1, y0 + params, adj_y, allow_unused=True)
+                adj_y = tuple(
+                    torch.zeros_like(y0_) if vjp is None else vjp for vjp, y0_ in zip(vjps[:n_states], y0)
+                )
+                for adj_p, vjp in zip(adj_params, vjps[n_states:]):
+                    if vjp is not None:
+                        adj_p.add_(vjp)
+            adj_y = tuple(adj + g[i] for adj, g in zip(adj_y, grad_solution))
+        ctx.checkpoints = None
+
+        return (None,) * 8 + adj_y + tuple(adj_params)
+
+
+def odeint_checkpoint(func, y0, t, rtol=1e-7, atol=1e-9, method="dopri5", options=None, info=None):
+    """Solves an ODE with an explicit Runge-Kutta method and backpropagates through the solver.
+
+    Only the states at the start of accepted steps are kept; the backward pass recomputes one step at a
+    time from them (adaptive checkpoint adjoint, Zhuang et al., 2020). The gradients are those of the
+    discrete solve, with no reverse-time ODE solve. The call signature follows torchdiffeq.odeint for a
+    tuple state. If `info` is a dict it receives the number of accepted steps and the next proposed step
+    size. The integration times are not differentiated.
+    """
+    if method not in _TABLEAUS:
+        raise ValueError("Unsupported solver for odeint_checkpoint: {}".format(method))
+    if t.requires_grad:
+        raise ValueError("odeint_checkpoint does not differentiate the integration times.")
+    n_states = len(y0)
+    atol = list(atol) if isinstance(atol, (list, tuple)) else [atol] * n_states
+    rtol = list(rtol) if isinstance(rtol, (list, tuple)) else [rtol] * n_states
+    options = {} if options is None else options
+    info = {} if info is None else info
+
+    params = tuple(p for p in func.parameters() if p.requires_grad)
+    return _CheckpointedOdeint.apply(func, method, t, atol, rtol, options, info, n_states, *y0, *params)
+
+
+class _Packing(object):
+    """Layout of a tuple of tensors inside one flat buffer."""
+
+    def __init__(self, tensors):
+        self.shapes = [tensor.shape for tensor in tensors]
+        self.offsets = [0]
+        for tensor in tensors:
+            self.offsets.append(self.offsets[-1] + tensor.numel())
+
+    @property
+    def numel(self):
+        return self.offsets[-1]
+
+    def unpack(self, flat):
+        return tuple(
+            flat[start:end].view(shape) for start, end, shape in zip(self.offsets[:-1], self.offsets[1:], self.shapes)
+        )
+
+    def pack(self, tensors, out):
+        for view, tensor in zip(self.unpack(out), tensors):
+            if tensor is None:
+                view.zero_()
+            else:
+                view.copy_(tensor)
+        return out
+
+
+def _grid(t0, t1, step_size):
+    """Step sizes from t0 to t1, all equal to step_size except a shorter last one."""
+    direction = 1. if t1 >= t0 else -1.
+    steps, t = [], t0
+    while (t1 - t) * direction > 0:
+        dt = t1 - t if step_size >= abs(t1 - t) else direction * step_size
+        steps.append((t, dt))
+        t = t1 if dt == t1 - t else t + dt
+    return steps
+
+
+def _fixed_grid_packed(flat_func, y, ts, step_size, tableau):
+    """Integrates dy/dt = flat_func(t, y, out) over the times ts, all in a single flat buffer.
+
+    flat_func writes the derivative into `out`. y is advanced in place; the workspaces are allocated once
+    for the whole solve. Returns the states at ts.
+    """
+    k = y.new_empty(len(tableau.b), y.numel())
+    yi = torch.empty_like(y)
+
+    solution = [y.clone()]
+    for t0, t1 in zip(ts[:-1], ts[1:]):
+        for t, dt in _grid(t0, t1, step_size):
+            flat_func(_time(t, y), y, k[0])
+            for i, (c_i, a_i) in enumerate(zip(tableau.c, tableau.a)):
+                yi.copy_(y)
+                for j, a_ij in enumerate(a_i):
+                    if a_ij != 0.:
+                        yi.add_(k[j], alpha=a_ij * dt)
+                flat_func(_time(t + c_i * dt, y), yi, k[i + 1])
+            for j, b_j in enumerate(tableau.b):
+                if b_j != 0.:
+                    y.add_(k[j], alpha=b_j * dt)
+        solution.append(y.clone())
+    return solution
+
+
+class _PackedOdeint(torch.autograd.Function):
+
+    @staticmethod
+    def forward(ctx, func, method, t, step_size, n_states, *args):
+        y0, params = args[:n_states], args[n_states:]
+        packing = _Packing(y0)
+        ctx.func, ctx.method, ctx.step_size, ctx.packing = func, method, step_size, packing
+
+        def flat_func(t, y, out):
+            packing.pack(func(t, packing.unpack(y)), out)
+
+        ts = t.tolist()
+        y = packing.pack(y0, y0[0].new_empty(packing.numel))
+        with torch.no_grad():
+            solution = _fixed_grid_packed(flat_func, y, ts, step_size, _TABLEAUS[method])
+
+        ctx.save_for_backward(t, torch.stack(solution), *params)
+        return tuple(torch.stack([view[n] for view in map(packing.unpack, solution)]) for n in range(n_states))
+
+    @staticmethod
+    def backward(ctx, *grad_solution):
+        func, packing = ctx.func, ctx.packing
+        t, solution, *params = ctx.saved_tensors
+        n, n_params = packing.numel, sum(p.numel() for p in params)
+        param_packing = _Packing(params)
+
+        # Augmented state [y | dL/dy | dL/dparams], integrated backwards with the same solver.
+        def aug_func(t, aug, out):
+            with torch.enable_grad():
+                y = tuple(y_.detach().requires_grad_(True) for y_ in packing.unpack(aug[:n]))
+                f = func(t, y)
+                vjps = torch.autograd.grad(f, y + tuple(params), packing.unpack(aug[n:2 * n]), allow_unused=True)
+            packing.pack(f, out[:n])
+            packing.pack(vjps[:len(y)], out[n:2 * n]).neg_()
+            if n_params:
+                param_packing.pack(vjps[len(y):], out[2 * n:]).neg_()
+
+        ts = t.tolist()
+        grad_flat = torch.stack([
+            torch.cat([g[i].reshape(-1) for g in grad_solution]) for i in range(len(ts))
+        ])
+        aug = solution.new_zeros(2 * n + n_params)
+        aug[n:2 * n] = grad_flat[-1]
+        for i in range(len(ts) - 1, 0, -1):
+            aug[:n] = solution[i]
+            with torch.no_grad():
+                _fixed_grid_packed(aug_func, aug, [ts[i], ts[i - 1]], ctx.step_size, _TABLEAUS[ctx.method])
+            aug[n:2 * n] += grad_flat[i - 1]
+
+        adj_y = packing.unpack(aug[n:2 * n])
+        adj_params = param_packing.unpack(aug[2 * n:])
+        return (None,) * 5 + tuple(adj_y) + tuple(adj_params)
+
+
+def odeint_packed(func, y0, t, method="rk4", options=None):
+    """Solves an ODE with a fixed-grid Runge-Kutta method, keeping the whole state in one flat buffer.
+
+    All stage arithmetic is done in place on preallocated workspaces, so the tiny logp and regularization
+    states cost no extra allocations. Gradients are computed with the adjoint method on the same grid,
+    as torchdiffeq.odeint_adjoint does for fixed-grid solvers. The call signature follows torchdiffeq.odeint
+    for a tuple state; options must contain step_size. The integration times are not differentiated.
+    """
+    if method not in PACKED_SOLVERS:
+        raise ValueError("Unsupported solver for odeint_packed: {}".format(method))
+    if options is None or options.get("step_size") is None:
+        raise ValueError("odeint_packed needs options['step_size'].")
+    if t.requires_grad:
+        raise ValueError("odeint_packed does not differentiate the integration times.")
+
+    params = tuple(p for p in func.parameters() if p.requires_grad)
+    return _PackedOdeint.apply(func, method, t, abs(float(options["step_size"])), len(y0), *y0, *params)
@@ -1,4 +1,5 @@
 import copy
+import warnings
 import numpy as np
 import torch
 import torch.nn as nn
@@ -11,10 +12,16 @@ __all__ = ["ODEnet", "AutoencoderDiffEqNet", "ODEfunc", "AutoencoderODEfunc"]
 
 
 def divergence_bf(dx, y, **unused_kwargs):
+    """Exact trace of d(dx)/dy with one backward pass per input dimension, for inputs of any shape."""
+    batchsize = y.shape[0]
+    dx = dx.view(batchsize, -1)
     sum_diag = 0.
-    for i in range(y.shape[1]):
-        sum_diag += torch.autograd.grad(dx[:, i].sum(), y, create_graph=True)[0].contiguous()[:, i].contiguous()
-    return sum_diag.contiguous()
+    sqnorm = 0.
+    for i in range(dx.shape[1]):
+        dxi_dy = torch.autograd.grad(dx[:, i].sum(), y, create_graph=True)[0].contiguous().view(batchsize, -1)
+        sum_diag += dxi_dy[:, i]
+        sqnorm += dxi_dy.pow(2).sum(dim=1)
+    return sum_diag, sqnorm / dx.shape[1]
 
 
 # def divergence_bf(f, y, **unused_kwargs):
@@ -45,34 +52,181 @@ def _get_minibatch_jacobian(y, x):
     return jac
 
 
+def _stack_probes(e):
+    """Returns the probe vectors as a single (K, N, ...) tensor."""
+    return e if torch.is_tensor(e) else torch.stack(list(e))
+
+
+_BATCHED_VJP = True
+
+
+def _batched_vjp(f, y, vs, create_graph=True):
+    """Computes the vector-Jacobian products of f wrt y for a stack of vectors in one backward pass.
+
+    Args:
+      f: (N, ...) output of the function.
+      y: (N, ...) input of the function.
+      vs: (K, N, ...) stacked vectors, one per product.
+    Returns:
+      The (K, N, ...) stacked products vs[k]^T df/dy.
+    """
+    global _BATCHED_VJP
+    if _BATCHED_VJP and vs.size(0) > 1:
+        try:
+            return torch.autograd.grad(
+                f, y, vs, create_graph=create_graph, retain_graph=True, is_grads_batched=True
+            )[0]
+        except (RuntimeError, TypeError) as err:
+            # is_grads_batched needs torch>=1.11 and a vmap batching rule for every op in the graph.
+            warnings.warn("Batched vector-Jacobian products unavailable, using a loop instead: {}".format(err))
+            _BATCHED_VJP = False
+    return torch.stack([
+        torch.autograd.grad(f, y, v, create_graph=create_graph, retain_graph=True)[0] for v in vs
+    ])
+
+
 def divergence_approx(f, y, e=None):
+    e = _stack_probes(e)
+    e_dzdx = _batched_vjp(f, y, e).view(e.size(0), y.size(0), -1)
+
+    sqnorm = e_dzdx.pow(2).mean(dim=2).mean(dim=0)
+    approx_tr_dzdx = (e_dzdx * e.view_as(e_dzdx)).sum(dim=2).mean(dim=0)
+
+    return approx_tr_dzdx, sqnorm
+
+
+def divergence_exact(f, y, e=None, chunk_size=None, max_basis_bytes=2**28, create_graph=True):
+    """Computes the exact trace of df/dy for inputs of any shape.
+
+    The basis vectors are pushed through batched vector-Jacobian products, `chunk_size` at a time. When
+    `chunk_size` is None it is chosen so that the stacked basis vectors and products of one chunk stay
+    under `max_basis_bytes`. This is not a cap on peak memory: the intermediates of the batched backward
+    pass grow with chunk_size times the hidden width of the network, so set chunk_size directly to bound
+    them. Use create_graph=False for evaluation, otherwise the graph of every chunk is kept alive until
+    the backward pass.
+    """
+    del e
+    batchsize = y.shape[0]
+    dim = y[0].numel()
+    if chunk_size is None:
+        chunk_size = max_basis_bytes // (2 * batchsize * dim * y.element_size())
+    chunk_size = int(max(1, min(chunk_size, dim)))
+
+    sum_diag = 0.
+    sqnorm = 0.
+    for start in range(0, dim, chunk_size):
+        k = min(chunk_size, dim - start)
+        rows_idx = torch.arange(k, device=y.device)
+        cols_idx = torch.arange(start, start + k, device=y.device)
+
+        basis = y.new_zeros(k, batchsize, dim)
+        basis[rows_idx, :, cols_idx] = 1
+        rows = _batched_vjp(f, y, basis.view(k, *y.shape), create_graph=create_graph).view(k, batchsize, dim)
+
+        sum_diag = sum_diag + rows[rows_idx, :, cols_idx].sum(dim=0)
+        sqnorm = sqnorm + rows.pow(2).sum(dim=(0, 2))
+    return sum_diag, sqnorm / dim
+
+
+def _hutchpp_rank(div_samples):
+    """Sketch size k of the Hutch++ estimators for a budget of div_samples vector-Jacobian products.
+
+    The estimators use 3k products, so the budget is rounded up to a multiple of three.
+    """
+    return max(1, -(-div_samples // 3))
+
+
+def _check_hutchpp_budget(div_samples):
+    budget = 3 * _hutchpp_rank(div_samples)
+    if budget != div_samples:
+        warnings.warn(
+            "Hutch++ needs a multiple of three vector-Jacobian products, div_samples={} is raised to {}."
+            .format(div_samples, budget)
+        )
+
+
+def _project(q, v):
+    """Projects the (J, N, D) vectors v onto the span of the orthonormal (K, N, D) columns q, per sample."""
+    coeffs = torch.einsum('knd,jnd->nkj', q, v)
+    return torch.einsum('nkj,knd->jnd', coeffs, q)
+
+
+def _hutchpp_sketch(f, y, e):
+    """Shared first stage of the Hutch++ estimators.
+
+    Splits the fixed probes into k sketch probes S and k test probes G, and returns a per-sample
+    orthonormal basis Q of (df/dy)^T S, the test probes and the Frobenius norm estimate from S.
+    """
+    batchsize, k = y.shape[0], e.size(0) // 2
+    e = e.view(e.size(0), batchsize, -1)
+    s_dzdx = _batched_vjp(f, y, e[:k].view(k, *y.shape)).view(k, batchsize, -1)
+    sqnorm = s_dzdx.pow(2).mean(dim=2).mean(dim=0)
+    q = torch.linalg.qr(s_dzdx.permute(1, 2, 0)).Q.permute(2, 0, 1)
+    return q, e[k:2 * k], sqnorm
+
 
-    samples = []
-    sqnorms = []
-    for  e_ in e:
-        e_dzdx = torch.autograd.grad(f, y, e_, create_graph=True)[0]
-        n = e_dzdx.view(y.size(0),-1).pow(2).mean(dim=1, keepdim=True)
-        sqnorms.append(n)
-        e_dzdx_e = e_dzdx * e_
-        samples.append(e_dzdx_e.view(y.shape[0], -1).sum(dim=1, keepdim=True))
+def divergence_hutchpp(f, y, e=None):
+    """Hutch++ trace estimator (Meyer et al., 2021).
 
-    S = torch.cat(samples, dim=1)
-    approx_tr_dzdx = S.mean(dim=1)
+    The trace is computed exactly on the span Q of the sketch and with Hutchinson's estimator on its
+    orthogonal complement, for 3k vector-Jacobian products in total. This only pays off when the spectrum of
+    the Jacobian decays quickly; at small budgets divergence_approx can have the lower variance.
+    """
+    e = _stack_probes(e)
+    batchsize, k = y.shape[0], e.size(0) // 2
+    q, g, sqnorm = _hutchpp_sketch(f, y, e)
+    g_perp = g - _project(q, g)
+
+    vjps = _batched_vjp(f, y, torch.cat([q, g_perp]).view(2 * k, *y.shape)).view(2 * k, batchsize, -1)
+    q_dzdx, g_dzdx = vjps[:k], vjps[k:]
+
+    tr_sketch = (q_dzdx * q).sum(dim=2).sum(dim=0)
+    tr_residual = (g_dzdx * g_perp).sum(dim=2).mean(dim=0)
+    return tr_sketch + tr_residual, sqnorm
 
-    N = torch.cat(sqnorms, dim=1).mean(dim=1)
 
+def divergence_hutchpp_cv(f, y, e=None):
+    """Hutchinson's estimator using the Hutch++ sketch as a control variate.
+
+    The quadratic form of the sketched Jacobian, g^T Q Q^T J Q Q^T g, has the known mean tr(Q^T J Q). It
+    is subtracted from each Hutchinson sample g^T J g and its mean is added back exactly. Same 3k budget
+    as divergence_hutchpp.
+    """
+    e = _stack_probes(e)
+    batchsize, k = y.shape[0], e.size(0) // 2
+    q, g, sqnorm = _hutchpp_sketch(f, y, e)
 
-    return approx_tr_dzdx, N
+    vjps = _batched_vjp(f, y, torch.cat([q, g]).view(2 * k, *y.shape)).view(2 * k, batchsize, -1)
+    q_dzdx, g_dzdx = vjps[:k], vjps[k:]
+
+    sketch = torch.einsum('ind,jnd->nij', q, q_dzdx)
+    coeffs = torch.einsum('knd,jnd->nkj', q, g)
+    control = torch.einsum('naj,nab,nbj->jn', coeffs, sketch, coeffs)
+
+    tr_sketch = torch.diagonal(sketch, dim1=1, dim2=2).sum(dim=1)
+    hutchinson = (g_dzdx * g).sum(dim=2)
+    return tr_sketch + (hutchinson - control).mean(dim=0), sqnorm
 
 
 def sample_rademacher_like(y):
-    return torch.randint(low=0, high=2, size=y.shape).to(y) * 2 - 1
+    return torch.empty_like(y).bernoulli_(0.5).mul_(2).sub_(1)
 
 
 def sample_gaussian_like(y):
     return torch.randn_like(y)
 
 
+def _orthogonal_probes(num_probes, y):
+    """Gaussian probes orthogonalised per sample and rescaled to norm sqrt(D), as a (K, N, ...) tensor.
+
+    Every probe is uniform on the sphere, so E[v v^T] = I still holds, and the probes of one sample
+    share no direction.
+    """
+    batchsize, dim = y.shape[0], y[0].numel()
+    q, _ = torch.linalg.qr(torch.randn(batchsize, dim, num_probes, dtype=y.dtype, device=y.device))
+    return (q.permute(2, 0, 1) * dim**0.5).reshape(num_probes, *y.shape)
+
+
 class Swish(nn.Module):
 
     def __init__(self):
@@ -283,94 +437,176 @@ class ODEfunc(nn.Module):
 
     def __init__(self, diffeq, divergence_fn="approximate", residual=False, rademacher=False, div_samples=1):
         super(ODEfunc, self).__init__()
-        assert divergence_fn in ("brute_force", "approximate")
+        assert divergence_fn in ("brute_force", "approximate", "exact", "hutchpp", "hutchpp_cv")
 
         # self.diffeq = diffeq_layers.wrappers.diffeq_wrapper(diffeq)
         self.diffeq = diffeq
         self.residual = residual
         self.rademacher = rademacher
         self.div_samples = div_samples
-        self.density=False
+        # "iid" Rademacher/Gaussian probes or "orthogonal" probes within each sample.
+        self.probe_mode = "iid"
+        self._probe_pool = {}
 
         if divergence_fn == "brute_force":
             self.divergence_fn = divergence_bf
         elif divergence_fn == "approximate":
             self.divergence_fn = divergence_approx
+        elif divergence_fn == "exact":
+            self.divergence_fn = divergence_exact
+        elif divergence_fn == "hutchpp":
+            self.divergence_fn = divergence_hutchpp
+        elif divergence_fn == "hutchpp_cv":
+            self.divergence_fn = divergence_hutchpp_cv
+        if divergence_fn in ("hutchpp", "hutchpp_cv"):
+            _check_hutchpp_budget(div_samples)
 
         self.register_buffer("_num_evals", torch.tensor(0.))
 
-    def before_odeint(self, e=None):
+    def before_odeint(self, e=None, direction=1.):
         self._e = e
+        # Sign of the integration direction. For decreasing times torchdiffeq integrates -t and passes the
+        # callbacks the original t0 with a positive dt.
+        self._direction = direction
         self._num_evals.fill_(0)
         self._sqjacnorm = None
+        self._last_step = None
+        self._step_sizes = []
+        self._num_rejected = 0
+        self._num_accepted_adjoint = 0
+        self._num_rejected_adjoint = 0
+        self._final_t = None
+        self._forward_evals = None
+        self._solve_time = None
+
+    def after_odeint(self, solve_time=None):
+        # Everything evaluated from here on belongs to the backward pass.
+        self._forward_evals = self._num_evals.clone()
+        self._solve_time = solve_time
 
     def num_evals(self):
         return self._num_evals.item()
 
-    def forward(self, t, states):
-        if True: # self.density:
-            assert len(states) >= 2
-            y = states[0]
+    def callback_accept_step(self, t0, y0, dt):
+        # Called by torchdiffeq's adaptive solvers after every accepted step. They already synchronize on
+        # every step, so the floats cost nothing extra.
+        self._last_step = abs(float(dt))
+        self._step_sizes.append(self._last_step)
+        self._final_t = float(t0) + self._direction * self._last_step
+
+    def callback_reject_step(self, t0, y0, dt):
+        self._num_rejected += 1
+
+    def callback_accept_step_adjoint(self, t0, y0, dt):
+        self._num_accepted_adjoint += 1
+
+    def callback_reject_step_adjoint(self, t0, y0, dt):
+        self._num_rejected_adjoint += 1
+
+    def solver_stats(self):
+        """Statistics of the latest solve, including its backward pass if it already ran."""
+        num_evals = self._num_evals.item()
+        forward_evals = num_evals if self._forward_evals is None else self._forward_evals.item()
+        step_sizes = list(self._step_sizes)
+        return {
+            "nfe_forward": forward_evals,
+            "nfe_adjoint": num_evals - forward_evals,
+            "accepted": len(step_sizes),
+            "rejected": self._num_rejected,
+            "accepted_adjoint": self._num_accepted_adjoint,
+            "rejected_adjoint": self._num_rejected_adjoint,
+            "step_sizes": step_sizes,
+            "final_t": self._final_t,
+            "time_per_eval": None if self._solve_time is None or not forward_evals else self._solve_time / forward_evals,
+        }
+
+    def last_accepted_step(self):
+        return self._last_step
+
+    def _num_probes(self):
+        divergence_fn = getattr(self.divergence_fn, "func", self.divergence_fn)
+        if divergence_fn in (divergence_hutchpp, divergence_hutchpp_cv):
+            return 2 * _hutchpp_rank(self.div_samples)
+        return self.div_samples
+
+    def _probe_groups(self):
+        # The Hutch++ test probes must stay independent of the sketch probes.
+        divergence_fn = getattr(self.divergence_fn, "func", self.divergence_fn)
+        if divergence_fn in (divergence_hutchpp, divergence_hutchpp_cv):
+            return (_hutchpp_rank(self.div_samples),) * 2
+        return (self.div_samples,)
+
+    def _sample_probes(self, y):
+        """Refills the preallocated probes for the shape, dtype and device of y in place.
+
+        The previous solve's probes are overwritten, so they must not be needed by a graph that is
+        still waiting for its backward pass (autograd raises if they are).
+        """
+        num_probes = self._num_probes()
+        key = (tuple(y.shape), y.dtype, y.device, num_probes)
+        e = self._probe_pool.get(key)
+        if e is None:
+            e = self._probe_pool[key] = y.new_empty(num_probes, *y.shape)
+
+        if self.probe_mode == "orthogonal":
+            start = 0
+            for size in self._probe_groups():
+                e[start:start + size].copy_(_orthogonal_probes(size, y))
+                start += size
+        elif self.rademacher:
+            e.bernoulli_(0.5).mul_(2).sub_(1)
+        else:
+            e.normal_()
+        return e
 
-            # increment num evals
+    def forward(self, t, states):
+        if isinstance(states, torch.Tensor):
+            # Sampling only: dz/dt without the divergence, probe noise or a forced autograd graph.
             self._num_evals += 1
+            dy = self.diffeq(t, states)
+            return dy - states if self.residual else dy
 
-            # convert to tensor
-            #t = torch.tensor(t).type_as(y)
-            batchsize = y.shape[0]
-
-            # Sample and fix the noise.
-            if self._e is None:
-                if self.rademacher:
-                    self._e = [sample_rademacher_like(y) for k in range(self.div_samples)]
-                else:
-                    self._e = [sample_gaussian_like(y) for k in range(self.div_samples)]
-
-            with torch.set_grad_enabled(True):
-                y.requires_grad_(True)
-                t.requires_grad_(True)
-                for s_ in states[2:]:
-                    s_.requires_grad_(True)
-
-                dy = self.diffeq(t, y, *states[2:])
-
-                divergence, sqjacnorm = self.divergence_fn(dy, y, e=self._e)
-                divergence = divergence.view(batchsize, 1)
-                self.sqjacnorm = sqjacnorm
-
-
-            #div_out = -torch.zeros(batchsize,1).to(dy)
-            #states[:2][:1].size = batch size, channels, height, width
-            if self.residual:
-                dy = dy - y
-                divergence -= torch.ones_like(divergence) * torch.tensor(np.prod(y.shape[1:]), dtype=torch.float32
-                                                                        ).to(divergence)
-            #out = tuple([dy, div_out]) 
-            #print('dy,-divergence: ', [dy, -divergence])
-            #dy size: batch size, channels, height, width
-            #print('2nd list ', [torch.zeros_like(s_).requires_grad_(True) for s_ in states[2:]]) EMPTY LIST !!! -> []
-
-            #out tuple len = 2 ; both elements are tensors, the second tensor is [[-0],[-0],[-0]]
-            #out[0].size = batch size, channels, height, width
-            return tuple([dy, -divergence] + [torch.zeros_like(s_).requires_grad_(True) for s_ in states[2:]])
-        
-
-        y = states
+        assert len(states) >= 2
+        y = states[0]
 
         # increment num evals
         self._num_evals += 1
 
         # convert to tensor
         #t = torch.tensor(t).type_as(y)
+        batchsize = y.shape[0]
+
+        # Sample and fix the noise.
+        if self._e is None:
+            self._e = self._sample_probes(y)
 
         with torch.set_grad_enabled(True):
             y.requires_grad_(True)
             t.requires_grad_(True)
+            for s_ in states[2:]:
+                s_.requires_grad_(True)
+
+            dy = self.diffeq(t, y, *states[2:])
 
-            dy = self.diffeq(t, y)
+            divergence, sqjacnorm = self.divergence_fn(dy, y, e=self._e)
+            divergence = divergence.view(batchsize, 1)
+            self.sqjacnorm = sqjacnorm
 
-        return tuple(dy)
 
+        #div_out = -torch.zeros(batchsize,1).to(dy)
+        #states[:2][:1].size = batch size, channels, height, width
+        if self.residual:
+            dy = dy - y
+            divergence -= torch.ones_like(divergence) * torch.tensor(np.prod(y.shape[1:]), dtype=torch.float32
+                                                                    ).to(divergence)
+        #out = tuple([dy, div_out]) 
+        #print('dy,-divergence: ', [dy, -divergence])
+        #dy size: batch size, channels, height, width
+        #print('2nd list ', [torch.zeros_like(s_).requires_grad_(True) for s_ in states[2:]]) EMPTY LIST !!! -> []
+
+        #out tuple len = 2 ; both elements are tensors, the second tensor is [[-0],[-0],[-0]]
+        #out[0].size = batch size, channels, height, width
+        return tuple([dy, -divergence] + [torch.zeros_like(s_).requires_grad_(True) for s_ in states[2:]])
 
 
 class AutoencoderODEfunc(nn.Module):
@@ -385,7 +621,7 @@ class AutoencoderODEfunc(nn.Module):
 
         self.register_buffer("_num_evals", torch.tensor(0.))
 
-    def before_odeint(self, e=None):
+    def before_odeint(self, e=None, direction=1.):
         self._e = e
         self._num_evals.fill_(0)
 
@@ -1,14 +1,20 @@
 import torch.nn as nn
+import torch.nn.functional as F
 
 __all__ = ['SqueezeLayer', 'squeeze', 'unsqueeze']
 
+# pixel_(un)shuffle use the same channel order as the reshapes below and take strided input, so the channel
+# halves left by a factor-out are rearranged with a single copy. The reshapes (torch < 1.8) only copy once too:
+# splitting H and W is a view of such a slice.
+_PIXEL_SHUFFLE = hasattr(F, "pixel_unshuffle")
+
 
 class SqueezeLayer(nn.Module):
     def __init__(self, downscale_factor):
         super(SqueezeLayer, self).__init__()
         self.downscale_factor = downscale_factor
         self.odelayer=False
-    def forward(self, x, logpx=None, reg_states=tuple(), reverse=False):
+    def forward(self, x, logpx=None, reg_states=tuple(), reverse=False, density=True):
         if reverse:
             return self._upsample(x, logpx, reg_states)
         else:
@@ -27,31 +33,37 @@ def unsqueeze(input, upscale_factor=2):
     '''
     [:, C*r^2, H, W] -> [:, C, H*r, W*r]
     '''
+    if _PIXEL_SHUFFLE:
+        return F.pixel_shuffle(input, upscale_factor)
+
     batch_size, in_channels, in_height, in_width = input.size()
     out_channels = in_channels // (upscale_factor**2)
 
     out_height = in_height * upscale_factor
     out_width = in_width * upscale_factor
 
-    input_view = input.contiguous().view(batch_size, out_channels, upscale_factor, upscale_factor, in_height, in_width)
+    input_view = input.reshape(batch_size, out_channels, upscale_factor, upscale_factor, in_height, in_width)
 
-    output = input_view.permute(0, 1, 4, 2, 5, 3).contiguous()
-    return output.view(batch_size, out_channels, out_height, out_width)
+    output = input_view.permute(0, 1, 4, 2, 5, 3)
+    return output.reshape(batch_size, out_channels, out_height, out_width)
 
 
 def squeeze(input, downscale_factor=2):
     '''
     [:, C, H*r, W*r] -> [:, C*r^2, H, W]
     '''
+    if _PIXEL_SHUFFLE:
+        return F.pixel_unshuffle(input, downscale_factor)
+
     batch_size, in_channels, in_height, in_width = input.size()
     out_channels = in_channels * (downscale_factor**2)
 
     out_height = in_height // downscale_factor
     out_width = in_width // downscale_factor
 
-    input_view = input.contiguous().view(
+    input_view = input.reshape(
         batch_size, in_channels, out_height, downscale_factor, out_width, downscale_factor
     )
 
-    output = input_view.permute(0, 1, 3, 5, 2, 4).contiguous()
-    return output.view(batch_size, out_channels, out_height, out_width)
+    output = input_view.permute(0, 1, 3, 5, 2, 4)
+    return output.reshape(batch_size, out_channels, out_height, out_width)
@@ -1,6 +1,12 @@
+import warnings
 import torch
 import torch.nn as nn
 
+try:
+    import torch.autograd.forward_ad as fwAD
+except ImportError:
+    fwAD = None
+
 
 
 class RegularizedODEfunc(nn.Module):
@@ -8,12 +14,24 @@ class RegularizedODEfunc(nn.Module):
         super(RegularizedODEfunc, self).__init__()
         self.odefunc = odefunc
         self.regularization_fns = regularization_fns
+        # Compute the built-in regularizers together, sharing their vector-Jacobian products.
+        self.fused = True
+        # Evaluate the regularizers in SPARSE_REGULARIZATION_FNS with probability sparse_prob, either per
+        # solve ("iter") or per function evaluation ("eval"), reweighted by 1 / sparse_prob. "eval" makes the
+        # dynamics stochastic within a solve, so the adjoint's backward evaluations need not match the forward.
+        self.sparse_prob = 1.0
+        self.sparse_mode = "iter"
+        self._sparse_active = True
 
     def before_odeint(self, *args, **kwargs):
         self.odefunc.before_odeint(*args, **kwargs)
+        if self.sparse_mode == "iter":
+            self._sparse_active = self._sample_sparse()
 
     def forward(self, t, state):
-
+        if isinstance(state, torch.Tensor):
+            # Sampling only, there is nothing to regularize.
+            return self.odefunc(t, state)
 
         with torch.enable_grad():
             x, logp = state[:2]
@@ -23,15 +41,59 @@ class RegularizedODEfunc(nn.Module):
             dstate = self.odefunc(t, (x, logp))
             if len(state) > 2:
                 dx, dlogp = dstate[:2]
-                reg_states = tuple(reg_fn(x, t, logp, dx, dlogp, self.odefunc) for reg_fn in self.regularization_fns)
-                return dstate + reg_states
+                return dstate + self._regularization_states(x, t, logp, dx, dlogp)
             else:
                 return dstate
 
+    def _sample_sparse(self):
+        return self.sparse_prob >= 1 or torch.rand(1).item() < self.sparse_prob
+
+    def _regularization_states(self, x, t, logp, dx, dlogp):
+        active = self._sparse_active if self.sparse_mode == "iter" else self._sample_sparse()
+        reg_fns = tuple(
+            reg_fn for reg_fn in self.regularization_fns if active or reg_fn not in SPARSE_REGULARIZATION_FNS
+        )
+        if self.fused and all(reg_fn in FUSED_REGULARIZATION_FNS for reg_fn in reg_fns):
+            computed = iter(fused_regularization(reg_fns, x, t, dx, self.odefunc))
+        else:
+            computed = iter(tuple(reg_fn(x, t, logp, dx, dlogp, self.odefunc) for reg_fn in reg_fns))
+
+        reg_states = []
+        for reg_fn in self.regularization_fns:
+            if reg_fn not in SPARSE_REGULARIZATION_FNS or self.sparse_prob >= 1:
+                reg_states.append(next(computed))
+            elif active:
+                # Unbiased: the expected integrand is unchanged, and the solver never controls the reg states.
+                reg_states.append(next(computed) / self.sparse_prob)
+            else:
+                reg_states.append(torch.zeros(x.size(0)).to(x).requires_grad_(True))
+        return tuple(reg_states)
+
     @property
     def _num_evals(self):
         return self.odefunc._num_evals
 
+    def after_odeint(self, *args, **kwargs):
+        self.odefunc.after_odeint(*args, **kwargs)
+
+    def callback_accept_step(self, t0, y0, dt):
+        self.odefunc.callback_accept_step(t0, y0, dt)
+
+    def callback_reject_step(self, t0, y0, dt):
+        self.odefunc.callback_reject_step(t0, y0, dt)
+
+    def callback_accept_step_adjoint(self, t0, y0, dt):
+        self.odefunc.callback_accept_step_adjoint(t0, y0, dt)
+
+    def callback_reject_step_adjoint(self, t0, y0, dt):
+        self.odefunc.callback_reject_step_adjoint(t0, y0, dt)
+
+    def last_accepted_step(self):
+        return self.odefunc.last_accepted_step()
+
+    def solver_stats(self):
+        return self.odefunc.solver_stats()
+
 
 def total_derivative(x, t, logp, dx, dlogp, unused_context):
     del logp, dlogp, unused_context
@@ -71,3 +133,64 @@ def jacobian_frobenius_regularization_fn(x, t, logp, dx, dlogp, context):
     sqjac = context.sqjacnorm
 
     return context.sqjacnorm
+
+
+FUSED_REGULARIZATION_FNS = (quadratic_cost, jacobian_frobenius_regularization_fn, directional_derivative, total_derivative)
+
+# Regularizers that need extra vector-Jacobian products or network evaluations. quadratic_cost and the
+# Jacobian norm reuse dx and the divergence probes, so they stay dense.
+SPARSE_REGULARIZATION_FNS = (directional_derivative, total_derivative)
+
+_FORWARD_AD = fwAD is not None
+
+
+def _partial_dt(x, t, dx, context):
+    """df/dt at fixed x, as a forward-mode JVP of one extra evaluation of the network."""
+    global _FORWARD_AD
+    if _FORWARD_AD:
+        try:
+            with fwAD.dual_level():
+                dual_t = fwAD.make_dual(t, torch.ones_like(t))
+                partial_dt = fwAD.unpack_dual(context.diffeq(dual_t, x)).tangent
+        except (RuntimeError, NotImplementedError) as e:
+            warnings.warn("Forward-mode AD failed ({}), falling back to double backward for df/dt.".format(e))
+            _FORWARD_AD = False
+        else:
+            if partial_dt is None:
+                raise RuntimeError('No partial derivative with respect to time. Use mathematically equivalent "directional_derivative" regularizer instead')
+            return partial_dt
+
+    try:
+        u = torch.full_like(dx, 1/x.numel(), requires_grad=True)
+        tmp = torch.autograd.grad((u*dx).sum(), t, create_graph=True)[0]
+        return torch.autograd.grad(tmp.sum(), u, create_graph=True)[0]
+    except RuntimeError as e:
+        if 'One of the differentiated Tensors' in e.__str__():
+            raise RuntimeError('No partial derivative with respect to time. Use mathematically equivalent "directional_derivative" regularizer instead')
+        raise
+
+
+def fused_regularization(regularization_fns, x, t, dx, context):
+    """Evaluates the built-in regularizers in one pass.
+
+    directional_derivative and total_derivative share a single vector-Jacobian product, and the time
+    derivative of total_derivative comes from forward-mode AD instead of two extra backward sweeps.
+    Returns the reg states in the order of regularization_fns.
+    """
+    batchsize = x.size(0)
+    directional_dx = None
+    if directional_derivative in regularization_fns or total_derivative in regularization_fns:
+        directional_dx = torch.autograd.grad(dx, x, dx, create_graph=True)[0]
+
+    reg_states = []
+    for reg_fn in regularization_fns:
+        if reg_fn is quadratic_cost:
+            reg_states.append(0.5*dx.view(batchsize, -1).pow(2).mean(dim=-1))
+        elif reg_fn is jacobian_frobenius_regularization_fn:
+            reg_states.append(context.sqjacnorm)
+        elif reg_fn is directional_derivative:
+            reg_states.append(0.5*directional_dx.pow(2).view(batchsize, -1).mean(dim=-1))
+        elif reg_fn is total_derivative:
+            total_deriv = directional_dx + _partial_dt(x, t, dx, context)
+            reg_states.append(0.5*total_deriv.pow(2).view(batchsize, -1).mean(dim=-1))
+    return tuple(reg_states)
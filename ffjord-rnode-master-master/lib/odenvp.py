@@ -30,6 +30,7 @@ class ODENVP(nn.Module):
         squeeze_first=False,
         zero_last=True,
         div_samples=1,
+        divergence_fn="approximate",
         alpha=0.05,
         cnf_kwargs=None,
     ):
@@ -45,6 +46,7 @@ class ODENVP(nn.Module):
         self.layer_type=layer_type
         self.zero_last=zero_last
         self.div_samples=div_samples
+        self.divergence_fn = divergence_fn
         self.nonlinearity = nonlinearity
         self.strides=strides
         self.squash_input = squash_input
@@ -68,6 +70,7 @@ class ODENVP(nn.Module):
                 StackedCNFLayers(
                     initial_size=(c, h, w),
                     div_samples=self.div_samples,
+                    divergence_fn=self.divergence_fn,
                     zero_last=self.zero_last,
                     layer_type=self.layer_type,
                     strides=self.strides,
@@ -106,9 +109,9 @@ class ODENVP(nn.Module):
                 output_sizes.append((n, c, h, w))
         return tuple(output_sizes)
 
-    def forward(self, x, logpx=None, reg_states=tuple(), reverse=False):
+    def forward(self, x, logpx=None, reg_states=tuple(), reverse=False, density=True):
         if reverse:
-            out = self._generate(x, logpx, reg_states)
+            out = self._generate(x, logpx, reg_states, density=density)
             if self.squeeze_first:
                 x = unsqueeze(out[0])
             else:
@@ -117,38 +120,47 @@ class ODENVP(nn.Module):
         else:
             if self.squeeze_first:
                 x = squeeze(x)
-            return self._logdensity(x, logpx, reg_states)
-
-    def _logdensity(self, x, logpx=None, reg_states=tuple()):
-        _logpx = torch.zeros(x.shape[0], 1).to(x) if logpx is None else logpx
-        out = []
+            return self._logdensity(x, logpx, reg_states, density=density)
+
+    def _logdensity(self, x, logpx=None, reg_states=tuple(), density=True):
+        _logpx = torch.zeros(x.shape[0], 1).to(x) if logpx is None and density else logpx
+        # The flows preserve dimension, so every scale writes its factored-out channels straight into the
+        # flat latent. Unlike a list of slices that are concatenated at the end, this lets each scale's
+        # activations be freed as soon as the next scale is done with them.
+        out = x.new_empty(x.shape[0], x[0].numel())
+        i = 0
         for idx in range(len(self.transforms)):
-            x, _logpx, reg_states = self.transforms[idx].forward(x, _logpx, reg_states)
+            x, _logpx, reg_states = self.transforms[idx].forward(x, _logpx, reg_states, reverse=False, density=density)
             if idx < len(self.transforms) - 1:
                 d = x.size(1) // 2
                 x, factor_out = x[:, :d], x[:, d:]
             else:
                 # last layer, no factor out
                 factor_out = x
-            out.append(factor_out)
-        out = [o.view(o.size()[0], -1) for o in out]
-        out = torch.cat(out, 1)
+            s = factor_out[0].numel()
+            out[:, i:i + s].view_as(factor_out).copy_(factor_out)
+            i += s
         return out, _logpx, reg_states
 
-    def _generate(self, z, logpz=None, reg_states=tuple()):
-        z = z.view(z.shape[0], -1)
+    def _latents(self, z):
+        """Views of the flat latent z, one per scale, shaped like the factored-out channels."""
+        z = z.reshape(z.shape[0], -1)
         zs = []
         i = 0
         for dims in self.dims:
-            s = np.prod(dims) #256x256
-            zs.append(z[:, i:i + s])
+            s = int(np.prod(dims)) #256x256
+            zs.append(z[:, i:i + s].view(z.shape[0], *dims))
             i += s
-        zs = [_z.view(_z.size()[0], *zsize) for _z, zsize in zip(zs, self.dims)] # I believe this is squeezing the noise/latent to match the output of the 'final' layer?
-        _logpz = torch.zeros(zs[0].shape[0], 1).to(zs[0]) if logpz is None else logpz
-        z_prev, _logpz, _ = self.transforms[-1](zs[-1], _logpz, reverse=True)
-        for idx in range(len(self.transforms) - 2, -1, -1): # if len(self.transforms) is 10 then idx will be 8,7,..,1,0
+        return zs
+
+    def _generate(self, z, logpz=None, reg_states=tuple(), density=True):
+        zs = self._latents(z)
+        _logpz = torch.zeros(zs[0].shape[0], 1).to(zs[0]) if logpz is None and density else logpz
+        z_prev, _logpz, _ = self.transforms[-1](zs[-1], _logpz, reverse=True, density=density)
+        for idx in range(len(self.transforms) - 2, -1, -1): # if len(self.transforms) is 10 then idx will be 8,7,..,1,0
+            # One copy per scale remains: the flows return new tensors, so z_prev cannot be produced in place.
             z_prev = torch.cat((z_prev, zs[idx]), dim=1)
-            z_prev, _logpz, reg_states = self.transforms[idx](z_prev, _logpz, reg_states, reverse=True)
+            z_prev, _logpz, reg_states = self.transforms[idx](z_prev, _logpz, reg_states, reverse=True, density=density)
         return z_prev, _logpz, reg_states
 
 
@@ -160,6 +172,7 @@ class StackedCNFLayers(layers.SequentialFlow):
         nonlinearity="softplus",
         layer_type="concat",
         div_samples=1,
+        divergence_fn="approximate",
         squeeze=True,
         init_layer=None,
         n_blocks=1,
@@ -173,7 +186,7 @@ class StackedCNFLayers(layers.SequentialFlow):
 
         def _make_odefunc(size):
             net = ODEnet(idims, size, strides, True, layer_type=layer_type, nonlinearity=nonlinearity, zero_last_weight=zero_last)
-            f = layers.ODEfunc(net, div_samples=div_samples)
+            f = layers.ODEfunc(net, divergence_fn=divergence_fn, div_samples=div_samples)
             return f
 
         if squeeze:
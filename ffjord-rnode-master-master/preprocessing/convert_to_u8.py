@@ -0,0 +1,20 @@
+"""Converts uint8 tensor datasets saved with torch.save to the memory-mapped .u8 format.
+
+    python preprocessing/convert_to_u8.py data/celebahq/celeba256_train.pth data/celebahq/celeba256_validation.pth
+
+CelebAHQ picks up the .u8 file next to its .pth automatically.
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from lib.datasets import convert_to_u8
+
+parser = argparse.ArgumentParser()
+parser.add_argument('files', nargs='+', help='.pth files holding a uint8 tensor')
+args = parser.parse_args()
+
+for loc in args.files:
+    print('{} -> {}'.format(loc, convert_to_u8(loc)), flush=True)
@@ -1,53 +1,203 @@
-import numpy as np
-import tensorflow as tf
-import torch
-
-sess = tf.InteractiveSession()
-
-train_imgs = []
-
-print('Reading from training set...', flush=True)
-for i in range(120):
-    tfr = 'data/celebahq/celeba-tfr/train/train-r08-s-{:04d}-of-0120.tfrecords'.format(i)
-    print(tfr, flush=True)
-
-    record_iterator = tf.python_io.tf_record_iterator(tfr)
-
-    for string_record in record_iterator:
-        example = tf.train.Example()
-        example.ParseFromString(string_record)
-
-        image_bytes = example.features.feature['data'].bytes_list.value[0]
+"""Extracts CelebA-HQ from Glow's TFRecords into memory-mapped .u8 files, without TensorFlow.
 
-        img = tf.decode_raw(image_bytes, tf.uint8)
-        img = tf.reshape(img, [256, 256, 3])
-        img = img.eval()
+Records are read with a small TFRecord reader (CRC-checked framing) and the 'data' feature is parsed straight
+from the protobuf wire format. Shards are processed in a process pool. Each worker writes its images directly
+into its slice of a preallocated output, so memory use does not grow with the dataset.
 
-        train_imgs.append(img)
+    python preprocessing/extract_celeba_from_tfrecords.py --root data/celebahq
 
-train_imgs = np.stack(train_imgs)
-train_imgs = torch.tensor(train_imgs).permute(0, 3, 1, 2)
-torch.save(train_imgs, 'data/celebahq/celeba256_train.pth')
+The crc32c package is used for the checksums when installed; the pure-Python fallback is slow, and
+--no_verify skips the data checksums.
+"""
+import argparse
+import os
+import struct
+import sys
+from multiprocessing import Pool
 
-validation_imgs = []
-for i in range(40):
-    tfr = 'data/celebahq/celeba-tfr/validation/validation-r08-s-{:04d}-of-0040.tfrecords'.format(i)
-    print(tfr, flush=True)
-
-    record_iterator = tf.python_io.tf_record_iterator(tfr)
-
-    for string_record in record_iterator:
-        example = tf.train.Example()
-        example.ParseFromString(string_record)
-
-        image_bytes = example.features.feature['data'].bytes_list.value[0]
-
-        img = tf.decode_raw(image_bytes, tf.uint8)
-        img = tf.reshape(img, [256, 256, 3])
-        img = img.eval()
-
-        validation_imgs.append(img)
+import numpy as np
 
-validation_imgs = np.stack(validation_imgs)
-validation_imgs = torch.tensor(validation_imgs).permute(0, 3, 1, 2)
-torch.save(validation_imgs, 'data/celebahq/celeba256_validation.pth')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from lib.datasets import create_u8, open_u8
+
+try:
+    from crc32c import crc32c
+except ImportError:
+    crc32c = None
+
+IMAGE_SHAPE = (256, 256, 3)
+
+SPLITS = {
+    'train': ('celeba-tfr/train/train-r08-s-{:04d}-of-0120.tfrecords', 120, 'celeba256_train'),
+    'validation': ('celeba-tfr/validation/validation-r08-s-{:04d}-of-0040.tfrecords', 40, 'celeba256_validation'),
+}
+
+
+def _crc32c_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x82F63B78 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+_CRC32C_TABLE = _crc32c_table()
+
+
+def _crc32c(data):
+    if crc32c is not None:
+        return crc32c(data)
+    crc = 0xFFFFFFFF
+    table = _CRC32C_TABLE
+    for byte in bytes(data):
+        crc = table[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+    return crc ^ 0xFFFFFFFF
+
+
+def _masked_crc(data):
+    crc = _crc32c(data)
+    return (((crc >> 15) | (crc << 17)) + 0xA282EAD8) & 0xFFFFFFFF
+
+
+def _read_header(f, path):
+    header = f.read(12)
+    if not header:
+        return None
+    if len(header) < 12:
+        raise IOError('Truncated record header in {}'.format(path))
+    length, length_crc = struct.unpack('<QI', header)
+    if _masked_crc(header[:8]) != length_crc:
+        raise IOError('Corrupt record length in {}'.format(path))
+    return length
+
+
+def count_records(path):
+    """Number of records in a TFRecord file, reading only the framing."""
+    count = 0
+    with open(path, 'rb') as f:
+        while True:
+            length = _read_header(f, path)
+            if length is None:
+                return count
+            f.seek(length + 4, os.SEEK_CUR)
+            count += 1
+
+
+def read_records(path, verify=True):
+    """Yields the records of a TFRecord file. The length checksum is always checked, the data one if verify."""
+    with open(path, 'rb') as f:
+        while True:
+            length = _read_header(f, path)
+            if length is None:
+                return
+            data = f.read(length)
+            footer = f.read(4)
+            if len(data) < length or len(footer) < 4:
+                raise IOError('Truncated record in {}'.format(path))
+            if verify and _masked_crc(data) != struct.unpack('<I', footer)[0]:
+                raise IOError('Corrupt record data in {}'.format(path))
+            yield data
+
+
+def _varint(buf, pos):
+    result = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _fields(buf):
+    """Yields (field number, value) for a protobuf message; length-delimited values are memoryview slices."""
+    pos = 0
+    while pos < len(buf):
+        key, pos = _varint(buf, pos)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, pos = _varint(buf, pos)
+        elif wire_type == 1:
+            value, pos = buf[pos:pos + 8], pos + 8
+        elif wire_type == 2:
+            size, pos = _varint(buf, pos)
+            value, pos = buf[pos:pos + size], pos + size
+        elif wire_type == 5:
+            value, pos = buf[pos:pos + 4], pos + 4
+        else:
+            raise ValueError('Unsupported protobuf wire type {}'.format(wire_type))
+        yield number, value
+
+
+def feature_bytes(record, name):
+    """The first value of a bytes_list feature of a serialized tf.train.Example."""
+    name = name.encode()
+    # Example.features = 1, Features.feature = 1 (map entries: key = 1, value = 2), Feature.bytes_list = 1,
+    # BytesList.value = 1.
+    for number, features in _fields(memoryview(record)):
+        if number != 1:
+            continue
+        for number, entry in _fields(features):
+            if number != 1:
+                continue
+            key = value = None
+            for field_number, field in _fields(entry):
+                if field_number == 1:
+                    key = bytes(field)
+                elif field_number == 2:
+                    value = field
+            if key != name or value is None:
+                continue
+            for kind, bytes_list in _fields(value):
+                if kind == 1:
+                    for field_number, item in _fields(bytes_list):
+                        if field_number == 1:
+                            return item
+    raise KeyError('No bytes feature {!r} in record'.format(name.decode()))
+
+
+def extract_shard(task):
+    tfr, out, offset, verify = task
+    images = open_u8(out, mode='r+')
+    i = offset
+    for record in read_records(tfr, verify=verify):
+        img = np.frombuffer(feature_bytes(record, 'data'), dtype=np.uint8).reshape(IMAGE_SHAPE)
+        images[i].numpy()[...] = img.transpose(2, 0, 1)
+        i += 1
+    return tfr, i - offset
+
+
+def extract_split(root, split, pool, verify=True):
+    pattern, num_shards, name = SPLITS[split]
+    shards = [os.path.join(root, pattern.format(i)) for i in range(num_shards)]
+    counts = pool.map(count_records, shards)
+    out = os.path.join(root, name + '.u8')
+    create_u8(out, (sum(counts), IMAGE_SHAPE[2], IMAGE_SHAPE[0], IMAGE_SHAPE[1]))
+
+    offsets = np.cumsum([0] + counts[:-1]).tolist()
+    tasks = [(tfr, out, offset, verify) for tfr, offset in zip(shards, offsets)]
+    for tfr, count in pool.imap_unordered(extract_shard, tasks):
+        print(tfr, count, flush=True)
+    return out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--root', type=str, default='data/celebahq')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--no_verify', action='store_true', help='skip the data checksums')
+    parser.add_argument('--pth', action='store_true', help='also write the .pth files (loads each split in memory)')
+    args = parser.parse_args()
+
+    with Pool(args.workers) as pool:
+        for split in ('train', 'validation'):
+            print('Reading from {} set...'.format(split), flush=True)
+            out = extract_split(args.root, split, pool, verify=not args.no_verify)
+            print('Wrote {}'.format(out), flush=True)
+            if args.pth:
+                import torch
+                torch.save(open_u8(out).clone(), os.path.splitext(out)[0] + '.pth')
@@ -0,0 +1,59 @@
+import pickle
+
+import pytest
+import torch
+
+from lib.datasets import Dataset, create_u8, open_u8, read_u8_shape, save_u8
+
+
+@pytest.fixture
+def images():
+    torch.manual_seed(0)
+    return torch.randint(0, 256, (5, 3, 4, 6), dtype=torch.uint8)
+
+
+def test_u8_roundtrip(tmp_path, images):
+    path = str(tmp_path / 'images.u8')
+    save_u8(path, images)
+    assert read_u8_shape(path) == tuple(images.shape)
+    assert torch.equal(open_u8(path), images)
+
+
+def test_u8_copy_on_write_leaves_the_file_untouched(tmp_path, images):
+    path = str(tmp_path / 'images.u8')
+    save_u8(path, images)
+    open_u8(path)[0].zero_()
+    assert torch.equal(open_u8(path), images)
+
+
+def test_u8_create_and_fill(tmp_path, images):
+    path = str(tmp_path / 'images.u8')
+    create_u8(path, images.shape)
+    data = open_u8(path, mode='r+')
+    data.copy_(images)
+    del data
+    assert torch.equal(open_u8(path), images)
+
+
+def test_u8_rejects_other_files(tmp_path, images):
+    path = str(tmp_path / 'images.pth')
+    torch.save(images, path)
+    with pytest.raises(ValueError):
+        read_u8_shape(path)
+    with pytest.raises(ValueError):
+        save_u8(str(tmp_path / 'floats.u8'), images.float())
+
+
+def test_u8_dataset_pickles_without_the_data(tmp_path):
+    images = torch.randint(0, 256, (64, 3, 8, 8), dtype=torch.uint8)
+    path = str(tmp_path / 'images.u8')
+    save_u8(path, images)
+    dataset = Dataset(path, in_mem=False)
+    x, _ = dataset[2]
+    assert torch.allclose(x, images[2].float() / 255)
+
+    state = pickle.dumps(dataset)
+    assert len(state) < images.numel()
+    clone = pickle.loads(state)
+    assert len(clone) == len(images)
+    assert torch.equal(clone[4][0], dataset[4][0])
@@ -0,0 +1,84 @@
+import pytest
+import torch
+
+from lib.layers.diffeq_layers import ConcatConv2d, ConcatCoordConv2d, ConcatSquashConv2d, HyperLinear
+
+
+def _grads(layer, t, x):
+    out = layer(t, x)
+    loss = (out ** 2).sum()
+    return (out.detach(),) + torch.autograd.grad(loss, (t, x) + tuple(layer.parameters()))
+
+
+def _inputs(shape):
+    t = torch.tensor(0.3, dtype=torch.float64, requires_grad=True)
+    x = torch.randn(*shape, dtype=torch.float64, requires_grad=True)
+    return t, x
+
+
+@pytest.mark.parametrize("layer_fn, shape", [
+    (lambda: HyperLinear(3, 4), (5, 3)),
+    (lambda: ConcatSquashConv2d(2, 3, ksize=3, padding=1), (2, 2, 4, 4)),
+])
+def test_time_cache_gradients(layer_fn, shape):
+    torch.manual_seed(0)
+    layer = layer_fn().double()
+    t, x = _inputs(shape)
+    layer._time_cache.max_size = 0
+    expected = _grads(layer, t, x)
+
+    layer._time_cache.max_size = 64
+    with torch.no_grad():
+        layer(t.detach().clone(), x)
+    # The second call is served from the cache and recomputes the network only in backward.
+    for actual, ref in zip(_grads(layer, t, x), expected):
+        assert torch.allclose(actual, ref, atol=1e-12)
+
+
+def test_time_cache_is_dropped_after_a_parameter_update():
+    torch.manual_seed(0)
+    layer = ConcatSquashConv2d(2, 3, ksize=3, padding=1).double()
+    t, x = _inputs((2, 2, 4, 4))
+    with torch.no_grad():
+        before = layer(t, x)
+        layer._hyper_gate.bias.add_(1.)
+        after = layer(t, x)
+        layer._time_cache.max_size = 0
+        assert not torch.allclose(before, after)
+        assert torch.allclose(after, layer(t, x))
+
+
+CONV_CASES = [
+    dict(ksize=3, stride=1, padding=1),
+    dict(ksize=3, stride=2, padding=1),
+    dict(ksize=4, stride=2, padding=1, transpose=True),
+    dict(ksize=3, stride=1, padding=0, transpose=True),
+]
+
+
+def _assert_fused_matches_concatenation(layer, shape):
+    t, x = _inputs(shape)
+    layer.fused = False
+    expected = _grads(layer, t, x)
+    layer.fused = True
+    for actual, ref in zip(_grads(layer, t, x), expected):
+        assert torch.allclose(actual, ref, atol=1e-10)
+    # Without a graph the constant responses come from the cache.
+    with torch.no_grad():
+        layer(t, x)
+        assert torch.allclose(layer(t, x), expected[0], atol=1e-10)
+
+
+@pytest.mark.parametrize("kwargs", CONV_CASES)
+def test_concat_conv_fused(kwargs):
+    torch.manual_seed(0)
+    _assert_fused_matches_concatenation(ConcatConv2d(2, 3, **kwargs).double(), (2, 2, 5, 5))
+
+
+@pytest.mark.parametrize("kwargs", CONV_CASES)
+def test_concat_coord_conv_fused(kwargs):
+    torch.manual_seed(0)
+    layer = ConcatCoordConv2d(2, 3, **kwargs).double()
+    _assert_fused_matches_concatenation(layer, (2, 2, 5, 5))
+    # A new spatial size gets its own grid and responses.
+    _assert_fused_matches_concatenation(layer, (1, 2, 6, 4))
@@ -0,0 +1,62 @@
+import pytest
+import torch
+import torch.nn as nn
+
+from lib.layers.odefunc import divergence_bf, divergence_exact, divergence_hutchpp, divergence_hutchpp_cv
+
+
+def _conv_field(shape=(2, 2, 3, 3)):
+    torch.manual_seed(0)
+    net = nn.Sequential(nn.Conv2d(shape[1], 4, 3, padding=1), nn.Softplus(), nn.Conv2d(4, shape[1], 3, padding=1))
+    y = torch.randn(*shape, dtype=torch.float64, requires_grad=True)
+    return y, net.double()(y)
+
+
+@pytest.mark.parametrize("chunk_size", [None, 1, 5, 100])
+def test_exact_matches_brute_force(chunk_size):
+    y, f = _conv_field()
+    div, sqnorm = divergence_exact(f, y, chunk_size=chunk_size)
+    ref_div, ref_sqnorm = divergence_bf(f, y)
+    assert torch.allclose(div, ref_div, atol=1e-10)
+    assert torch.allclose(sqnorm, ref_sqnorm, atol=1e-10)
+
+
+def test_exact_memory_bound_chunks():
+    # A budget below one basis vector still makes progress, one dimension at a time.
+    y, f = _conv_field()
+    div, _ = divergence_exact(f, y, max_basis_bytes=1)
+    assert torch.allclose(div, divergence_bf(f, y)[0], atol=1e-10)
+
+
+def test_exact_is_differentiable():
+    y, f = _conv_field()
+    grad = torch.autograd.grad(divergence_exact(f, y)[0].sum(), y)[0]
+    ref_grad = torch.autograd.grad(divergence_bf(f, y)[0].sum(), y)[0]
+    assert torch.allclose(grad, ref_grad, atol=1e-10)
+
+
+def _linear_field(dim=10, batchsize=3):
+    torch.manual_seed(0)
+    a = torch.randn(dim, dim, dtype=torch.float64)
+    y = torch.randn(batchsize, dim, dtype=torch.float64, requires_grad=True)
+    return y, y @ a.t(), torch.trace(a)
+
+
+def _rademacher(k, y):
+    return torch.randint(0, 2, (2 * k,) + y.shape, dtype=y.dtype).mul(2).sub(1)
+
+
+@pytest.mark.parametrize("divergence_fn", [divergence_hutchpp, divergence_hutchpp_cv])
+def test_hutchpp_is_unbiased(divergence_fn):
+    y, f, trace = _linear_field()
+    samples = torch.stack([divergence_fn(f, y, _rademacher(2, y))[0].detach() for _ in range(2000)])
+    mean, stderr = samples.mean(), samples.std() / samples.numel() ** 0.5
+    assert abs(mean - trace) < 4 * stderr + 1e-8
+
+
+@pytest.mark.parametrize("divergence_fn", [divergence_hutchpp, divergence_hutchpp_cv])
+def test_hutchpp_is_exact_for_a_full_sketch(divergence_fn):
+    # Gaussian probes, as a square Rademacher sketch is singular with a noticeable probability.
+    y, f, trace = _linear_field(dim=4)
+    div, _ = divergence_fn(f, y, torch.randn((8,) + y.shape, dtype=y.dtype))
+    assert torch.allclose(div, trace.expand_as(div), atol=1e-8)
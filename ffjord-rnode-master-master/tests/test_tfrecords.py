@@ -0,0 +1,92 @@
+import importlib.util
+import os
+import struct
+
+import numpy as np
+import pytest
+import torch
+
+from lib.datasets import create_u8, open_u8
+
+_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'preprocessing',
+                     'extract_celeba_from_tfrecords.py')
+_spec = importlib.util.spec_from_file_location('extract_celeba_from_tfrecords', _PATH)
+tfr = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(tfr)
+
+
+def _varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _bytes_field(number, payload):
+    return _varint(number << 3 | 2) + _varint(len(payload)) + payload
+
+
+def _example(features):
+    """A serialized tf.train.Example with one bytes_list feature per item of `features`."""
+    entries = b''
+    for key, value in features.items():
+        feature = _bytes_field(1, _bytes_field(1, value))
+        entries += _bytes_field(1, _bytes_field(1, key.encode()) + _bytes_field(2, feature))
+    # A varint field ahead of the entries checks that unknown fields are skipped.
+    return _bytes_field(1, _varint(2 << 3 | 0) + _varint(300) + entries)
+
+
+def _write_records(path, records):
+    with open(path, 'wb') as f:
+        for record in records:
+            length = struct.pack('<Q', len(record))
+            f.write(length + struct.pack('<I', tfr._masked_crc(length)))
+            f.write(record + struct.pack('<I', tfr._masked_crc(record)))
+
+
+def test_crc32c_check_value():
+    assert tfr._crc32c(b'123456789') == 0xE3069283
+
+
+def test_read_records_and_features(tmp_path):
+    path = str(tmp_path / 'shard.tfrecords')
+    records = [_example({'shape': b'\x01\x02', 'data': bytes([i]) * 7}) for i in range(3)]
+    _write_records(path, records)
+
+    assert tfr.count_records(path) == 3
+    read = list(tfr.read_records(path))
+    assert read == records
+    assert [bytes(tfr.feature_bytes(r, 'data')) for r in read] == [bytes([i]) * 7 for i in range(3)]
+    with pytest.raises(KeyError):
+        tfr.feature_bytes(read[0], 'label')
+
+
+def test_read_records_detects_corruption(tmp_path):
+    path = str(tmp_path / 'shard.tfrecords')
+    _write_records(path, [_example({'data': b'abcdef'})])
+    with open(path, 'r+b') as f:
+        f.seek(-6, os.SEEK_END)
+        f.write(b'X')
+    with pytest.raises(IOError):
+        list(tfr.read_records(path))
+    assert len(list(tfr.read_records(path, verify=False))) == 1
+
+
+def test_extract_shard(tmp_path, monkeypatch):
+    shape = (2, 3, 3)
+    monkeypatch.setattr(tfr, 'IMAGE_SHAPE', shape)
+    images = np.arange(4 * 18, dtype=np.uint8).reshape(4, *shape)
+    path = str(tmp_path / 'shard.tfrecords')
+    _write_records(path, [_example({'data': img.tobytes()}) for img in images[1:3]])
+    out = str(tmp_path / 'images.u8')
+    create_u8(out, (4, shape[2], shape[0], shape[1]))
+
+    assert tfr.extract_shard((path, out, 1, True)) == (path, 2)
+    expected = torch.from_numpy(images.transpose(0, 3, 1, 2).copy())
+    expected[0] = expected[3] = 0
+    assert torch.equal(open_u8(out), expected)
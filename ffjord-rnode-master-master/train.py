@@ -20,12 +20,16 @@ from torchvision.utils import save_image
 import lib.layers as layers
 import lib.utils as utils
 import lib.odenvp as odenvp
-from lib.datasets import CelebAHQ, Imagenet64
+from lib.datasets import CelebAHQ, Imagenet64, FastCollate
 
 from train_misc import standard_normal_logprob
 from train_misc import set_cnf_options, count_nfe, count_parameters, count_total_time
+from train_misc import ToleranceScheduler
+from train_misc import count_solver_stats, format_solver_stats
+from train_misc import apply_cnf_config, load_cnf_config
 from train_misc import create_regularization_fns, get_regularization, append_regularization_to_log
 from train_misc import append_regularization_keys_header, append_regularization_csv_dict
+from train_misc import ensure_csv_header
 
 import dist_utils
 from dist_utils import env_world_size, env_rank
@@ -47,7 +51,10 @@ def get_parser():
         "--layer_type", type=str, default="concat",
         choices=["ignore", "concat"]
     )
-    parser.add_argument("--divergence_fn", type=str, default="approximate", choices=["brute_force", "approximate"])
+    parser.add_argument(
+        "--divergence_fn", type=str, default="approximate",
+        choices=["brute_force", "approximate", "exact", "hutchpp", "hutchpp_cv"]
+    )
     parser.add_argument(
         "--nonlinearity", type=str, default="softplus", choices=["tanh", "relu", "softplus", "elu"]
     )
@@ -55,14 +62,37 @@ def get_parser():
     parser.add_argument('--optimizer', type=str, default='adam', choices=['adam', 'sgd'])
     parser.add_argument('--atol', type=float, default=1e-5, help='only for adaptive solvers')
     parser.add_argument('--rtol', type=float, default=1e-5,  help='only for adaptive solvers')
+    parser.add_argument('--error_control', type=str, default='z_logp', choices=['z_logp', 'z'],
+                        help='state tensors under adaptive step control, the reg states never are')
+    parser.add_argument('--logp_atol', type=float, default=None, help='atol of logp, defaults to --atol')
+    parser.add_argument('--logp_rtol', type=float, default=None, help='rtol of logp, defaults to --rtol')
     parser.add_argument('--step_size', type=float, default=0.25, help='only for fixed step size solvers')
     parser.add_argument('--first_step', type=float, default=0.166667, help='only for adaptive solvers')
+    parser.add_argument('--warm_start', type=eval, default=True, choices=[True, False],
+                        help='start each adaptive solve from the last accepted step size of that CNF block')
+    parser.add_argument('--integration', type=str, default='adjoint', choices=['adjoint', 'checkpoint', 'auto'],
+                        help='backpropagate with the adjoint ODE, through checkpointed solver steps, or pick per block '
+                             '(a trainable T always uses the adjoint)')
+    parser.add_argument('--checkpoint_budget_mb', type=float, default=1024,
+                        help='memory for the stored states of one checkpointed solve when --integration auto')
+    parser.add_argument('--packed_state', type=eval, default=False, choices=[True, False],
+                        help='integrate fixed-grid solvers over one flat state buffer instead of torchdiffeq')
+    parser.add_argument('--solver_stats', type=eval, default=False, choices=[True, False],
+                        help='time every solve and log per-scale step, rejection and NFE statistics')
+    parser.add_argument('--tol_schedule', type=str, default='none', choices=['none', 'plateau', 'step'],
+                        help='start with loose training tolerances and tighten them to --atol/--rtol')
+    parser.add_argument('--tol_start_scale', type=float, default=100., help='initial multiple of --atol/--rtol')
+    parser.add_argument('--tol_factor', type=float, default=10**0.5, help='tightening factor per schedule step')
+    parser.add_argument('--tol_patience', type=int, default=500,
+                        help='iterations without bpd improvement (plateau) or between steps (step)')
+    parser.add_argument('--tol_threshold', type=float, default=1e-3, help='bpd improvement that resets the plateau')
 
     parser.add_argument('--test_solver', type=str, default=None, choices=SOLVERS + [None])
     parser.add_argument('--test_atol', type=float, default=None)
     parser.add_argument('--test_rtol', type=float, default=None)
     parser.add_argument('--test_step_size', type=float, default=None)
     parser.add_argument('--test_first_step', type=float, default=None)
+    parser.add_argument('--cnf_config', type=str, default=None, help='per-block test solver settings from calibrate_solver.py')
 
     parser.add_argument("--imagesize", type=int, default=None)
     parser.add_argument("--alpha", type=float, default=1e-6)
@@ -82,6 +112,8 @@ def get_parser():
     parser.add_argument("--add_noise", type=eval, default=True, choices=[True, False])
     parser.add_argument('--nbits', type=int, default=8)
     parser.add_argument('--div_samples',type=int, default=1)
+    parser.add_argument('--probe_mode', type=str, default='iid', choices=['iid', 'orthogonal'],
+                        help='independent probes or probes orthogonalised within each sample')
     parser.add_argument('--squeeze_first', type=eval, default=False, choices=[True, False])
     parser.add_argument('--zero_last', type=eval, default=True, choices=[True, False])
     parser.add_argument('--seed', type=int, default=42)
@@ -91,6 +123,10 @@ def get_parser():
     parser.add_argument('--jacobian-norm2', type=float, default=None, help="int_t ||df/dx||_F^2")
     parser.add_argument('--total-deriv', type=float, default=None, help="int_t ||df/dt||^2")
     parser.add_argument('--directional-penalty', type=float, default=None, help="int_t ||(df/dx)^T f||^2")
+    parser.add_argument('--reg_sparse_prob', type=float, default=1.0,
+                        help='probability of evaluating the directional and total derivative penalties, reweighted')
+    parser.add_argument('--reg_sparse_mode', type=str, default='iter', choices=['iter', 'eval'],
+                        help='draw once per solve or per function evaluation')
 
     parser.add_argument(
         "--max_grad_norm", type=float, default=np.inf,
@@ -214,31 +250,14 @@ def get_dataset(args):
         )
     data_shape = (im_dim, im_size, im_size)
 
-    def fast_collate(batch): ##** 
-
-        imgs = [img[0] for img in batch]
-        targets = torch.tensor([target[1] for target in batch], dtype=torch.int64)
-        w = imgs[0].size[0]
-        h = imgs[0].size[1]
-
-        tensor = torch.zeros( (len(imgs), im_dim, im_size, im_size), dtype=torch.uint8 )
-        for i, img in enumerate(imgs):
-            nump_array = np.asarray(img, dtype=np.uint8)
-            tens = torch.from_numpy(nump_array)
-            if(nump_array.ndim < 3):
-                nump_array = np.expand_dims(nump_array, axis=-1)
-            nump_array = np.rollaxis(nump_array, 2)
-            tensor[i] += torch.from_numpy(nump_array)
-
-        return tensor, targets
-
     train_sampler = (DistributedSampler(train_set,
         num_replicas=env_world_size(), rank=env_rank()) if args.distributed
         else None)
 
     train_loader = torch.utils.data.DataLoader(
         dataset=train_set, batch_size=args.batch_size, #shuffle=True,
-        num_workers=args.nworkers, pin_memory=True, sampler=train_sampler, collate_fn=fast_collate
+        num_workers=args.nworkers, pin_memory=True, sampler=train_sampler,
+        collate_fn=FastCollate(pin_memory=torch.cuda.is_available())
     )
 
     test_sampler = (DistributedSampler(test_set,
@@ -247,7 +266,8 @@ def get_dataset(args):
 
     test_loader = torch.utils.data.DataLoader(
         dataset=test_set, batch_size=args.test_batch_size, #shuffle=False,
-        num_workers=args.nworkers, pin_memory=True, sampler=test_sampler, collate_fn=fast_collate
+        num_workers=args.nworkers, pin_memory=True, sampler=test_sampler,
+        collate_fn=FastCollate(pin_memory=torch.cuda.is_available())
     )
 
     return train_loader, test_loader, data_shape
@@ -278,6 +298,7 @@ def create_model(args, data_shape, regularization_fns):
         n_blocks=args.num_blocks,
         intermediate_dims=hidden_dims,
         div_samples=args.div_samples,
+        divergence_fn=args.divergence_fn,
         strides=strides,
         squeeze_first=args.squeeze_first,
         nonlinearity=args.nonlinearity,
@@ -321,7 +342,7 @@ def main():
     trainlog = os.path.join(args.save,'training.csv')
     testlog = os.path.join(args.save,'test.csv')
 
-    traincolumns = ['itr','wall','itr_time','loss','bpd','fe','total_time','grad_norm'] ##lg
+    traincolumns = ['itr','wall','itr_time','loss','bpd','fe','total_time','grad_norm','atol','rtol'] ##lg
     testcolumns = ['wall','epoch','eval_time','bpd','fe', 'total_time', 'transport_cost']
 
     # build model
@@ -342,6 +363,8 @@ def main():
             csvlogger.writeheader()
 
     set_cnf_options(args, model)
+    if args.cnf_config is not None:
+        apply_cnf_config(model, load_cnf_config(args.cnf_config))
 
     if write_log: logger.info(model)
     if write_log: logger.info("Number of trainable parameters: {}".format(count_parameters(model)))
@@ -394,6 +417,18 @@ def main():
         best_loss = tedf['bpd'].min()
         begin_epoch = int(tedf['epoch'].to_numpy()[-1]+1) # not exactly correct
 
+    tol_scheduler = None
+    if args.tol_schedule != 'none':
+        tol_scheduler = ToleranceScheduler(model, args.atol, args.rtol, mode=args.tol_schedule,
+                                           start_scale=args.tol_start_scale, factor=args.tol_factor,
+                                           patience=args.tol_patience, threshold=args.tol_threshold)
+        if args.resume and 'atol' in trdf:
+            tol_scheduler.restore(trdf['atol'].to_numpy()[-1])
+
+    if args.resume and write_log:
+        # After the old log has been read: a training.csv from before the atol/rtol columns is moved aside.
+        ensure_csv_header(trainlog, traincolumns)
+
     if args.distributed:
         if write_log: logger.info('Syncing machines before training')
         dist_utils.sum_tensor(torch.tensor([1.0]).float().cuda())
@@ -452,6 +487,9 @@ def main():
                     rv = tuple(torch.tensor(0.).cuda() for r in reg_states)
 
                     total_gpus, batch_total, r_loss, r_bpd, r_nfe, r_grad_norm, *rv = dist_utils.sum_tensor(metrics).cpu().numpy()
+                    if tol_scheduler is not None and tol_scheduler.step(r_bpd/total_gpus) and write_log:
+                        logger.info("Itr {:06d} | tightened tolerances to atol {:.2e}, rtol {:.2e}".format(
+                            itr, tol_scheduler.atol, tol_scheduler.rtol))
 
 
                     
@@ -471,6 +509,8 @@ def main():
                             'total_time':fmt.format(total_time),
                             'fe': r_nfe/total_gpus,
                             'grad_norm': fmt.format(r_grad_norm/total_gpus),
+                            'atol': tol_scheduler.atol if tol_scheduler is not None else args.atol,
+                            'rtol': tol_scheduler.rtol if tol_scheduler is not None else args.rtol,
                             }
                         if regularization_coeffs:
                             rv = tuple(v_/total_gpus for v_ in rv)
@@ -498,6 +538,8 @@ def main():
                                 log_message = append_regularization_to_log(log_message,
                                         regularization_fns, rv)
                             logger.info(log_message)
+                            if args.solver_stats:
+                                logger.info(format_solver_stats(count_solver_stats(model)))
 
 
 
@@ -573,7 +615,7 @@ def main():
                 with torch.no_grad():
                     fig_filename = os.path.join(args.save, "figs", "{:04d}.jpg".format(epoch))
                     utils.makedirs(os.path.dirname(fig_filename))
-                    generated_samples, _, _ = model(fixed_z, reverse=True)
+                    generated_samples, _, _ = model(fixed_z, reverse=True, density=False)
                     generated_samples = generated_samples.view(-1, *data_shape)
                     nb = int(np.ceil(np.sqrt(float(fixed_z.size(0)))))
                     save_image(unshift(generated_samples, nbits=args.nbits), fig_filename, nrow=nb)
@@ -1,9 +1,20 @@
+import os
+import csv
 import six
 import math
+import functools
+import yaml
+
+import torch
+import torchvision.datasets as dset
+import torchvision.transforms as tforms
 
 import lib.layers.wrappers.cnf_regularization as reg_lib
 import lib.layers as layers
-from lib.layers.odefunc import divergence_bf, divergence_approx
+import lib.odenvp as odenvp
+from lib.datasets import CelebAHQ
+from lib.layers.odefunc import divergence_bf, divergence_approx, divergence_exact
+from lib.layers.odefunc import divergence_hutchpp, divergence_hutchpp_cv, _check_hutchpp_budget
 
 
 def standard_normal_logprob(z):
@@ -20,6 +31,86 @@ def set_step_size(step_size, model):
     model.apply(_set)
 
 
+def set_tolerance(atol, rtol, model):
+
+    def _set(module):
+        if isinstance(module, layers.CNF):
+            # Set training settings
+            module.atol = atol
+            module.rtol = rtol
+
+    model.apply(_set)
+
+
+class ToleranceScheduler(object):
+    """Starts training with the tolerances loosened by start_scale and tightens them to atol/rtol.
+
+    In "plateau" mode the scale is divided by `factor` when the running bits/dim has not improved by
+    more than `threshold` for `patience` iterations. In "step" mode it is divided every `patience`
+    iterations. The running bits/dim uses bpd_meter's momentum, but step() must be fed the all-reduced
+    bits/dim so that every rank makes the same decisions.
+    """
+
+    def __init__(self, model, atol, rtol, mode="plateau", start_scale=100., factor=10.**0.5, patience=500,
+                 threshold=1e-3, momentum=0.97):
+        assert mode in ("plateau", "step")
+        self.model = model
+        self.mode = mode
+        self.factor = factor
+        self.patience = patience
+        self.threshold = threshold
+        self.momentum = momentum
+        self._atol = atol
+        self._rtol = rtol
+        self.scale = max(1., start_scale)
+        self._avg = None
+        self._best = float("inf")
+        self._num_bad_itrs = 0
+        set_tolerance(self.atol, self.rtol, self.model)
+
+    @property
+    def atol(self):
+        return self._atol * self.scale
+
+    @property
+    def rtol(self):
+        return self._rtol * self.scale
+
+    def restore(self, atol):
+        """Resumes from the atol of the last row of training.csv."""
+        self.scale = max(1., atol / self._atol)
+        set_tolerance(self.atol, self.rtol, self.model)
+
+    def step(self, bpd):
+        """Returns True when the tolerances were tightened."""
+        if self.scale <= 1.:
+            return False
+        self._avg = bpd if self._avg is None else self._avg * self.momentum + bpd * (1 - self.momentum)
+        self._num_bad_itrs += 1
+        if self.mode == "plateau" and self._avg < self._best - self.threshold:
+            self._best = self._avg
+            self._num_bad_itrs = 0
+        if self._num_bad_itrs < self.patience:
+            return False
+
+        self.scale = max(1., self.scale / self.factor)
+        # Tighter tolerances shift the estimate, so measure the next plateau from here.
+        self._best = self._avg
+        self._num_bad_itrs = 0
+        set_tolerance(self.atol, self.rtol, self.model)
+        return True
+
+
+def set_sparse_regularization(prob, mode, model):
+
+    def _set(module):
+        if isinstance(module, reg_lib.RegularizedODEfunc):
+            module.sparse_prob = prob
+            module.sparse_mode = mode
+
+    model.apply(_set)
+
+
 def set_cnf_options(args, model):
 
     def _set(module):
@@ -32,6 +123,15 @@ def set_cnf_options(args, model):
                 module.solver_options['step_size'] = args.step_size
             if args.first_step is not None:
                 module.solver_options['first_step'] = args.first_step
+            module.warm_start = getattr(args, 'warm_start', module.warm_start)
+            module.integration = getattr(args, 'integration', module.integration)
+            module.packed_state = getattr(args, 'packed_state', module.packed_state)
+            module.time_solves = getattr(args, 'solver_stats', module.time_solves)
+            module.error_control = getattr(args, 'error_control', module.error_control)
+            module.logp_atol = getattr(args, 'logp_atol', module.logp_atol)
+            module.logp_rtol = getattr(args, 'logp_rtol', module.logp_rtol)
+            if getattr(args, 'checkpoint_budget_mb', None) is not None:
+                module.checkpoint_budget = int(args.checkpoint_budget_mb * 2**20)
 
             # If using fixed-grid adams, restrict order to not be too high.
             if args.solver in ['fixed_adams', 'explicit_adams']:
@@ -46,11 +146,112 @@ def set_cnf_options(args, model):
             if args.test_first_step is not None:
                 module.test_solver_options['first_step'] = args.test_first_step
 
+        if isinstance(module, layers.ODEfunc):
+            module.probe_mode = getattr(args, 'probe_mode', module.probe_mode)
 
     model.apply(_set)
 
+    if getattr(args, 'reg_sparse_prob', None) is not None:
+        set_sparse_regularization(args.reg_sparse_prob, getattr(args, 'reg_sparse_mode', 'iter'), model)
+
+
+CNF_CONFIG_KEYS = ("test_solver", "test_atol", "test_rtol", "test_solver_options")
+
+
+def get_cnf_config(model):
+    """Returns the test-time solver settings of every CNF block, in model.modules() order."""
+    return [
+        {"test_solver": module.test_solver, "test_atol": module.test_atol, "test_rtol": module.test_rtol,
+         "test_solver_options": dict(module.test_solver_options)}
+        for module in model.modules() if isinstance(module, layers.CNF)
+    ]
+
+
+def apply_cnf_config(model, config):
+    cnfs = [module for module in model.modules() if isinstance(module, layers.CNF)]
+    if len(cnfs) != len(config):
+        raise ValueError("Config has {} CNF blocks, the model has {}".format(len(config), len(cnfs)))
+    for module, block_config in zip(cnfs, config):
+        for key in CNF_CONFIG_KEYS:
+            if key in block_config:
+                setattr(module, key, dict(block_config[key]) if key == "test_solver_options" else block_config[key])
+
+
+def save_cnf_config(path, config, **metadata):
+    with open(path, "w") as f:
+        yaml.dump(dict(metadata, blocks=config), f, default_flow_style=False)
 
-def override_divergence_fn(model, divergence_fn):
+
+def load_cnf_config(path):
+    with open(path, "r") as f:
+        return yaml.safe_load(f)["blocks"]
+
+
+def calibrate_cnf_config(model, evaluate, candidates, max_bpd_error, seed=0, logger=None):
+    """Greedy per-block search for the cheapest test-time solver settings.
+
+    evaluate(model) returns (bits/dim, NFE) on a fixed set of validation batches. It is always run
+    from the same seed, so the probe noise does not hide the solver error. The reference is the model
+    with the settings it has on entry. Blocks are visited in order, and each takes the candidate with
+    the fewest NFE that keeps the bits/dim of the whole model within max_bpd_error of the reference.
+    Returns the config and the reference bits/dim.
+
+    Every evaluation starts from empty warm-start and step-count state, so no candidate inherits the
+    first step of the one before it. The state on entry is restored afterwards.
+    """
+    cnfs = [module for module in model.modules() if isinstance(module, layers.CNF)]
+    saved = [(dict(cnf._warm_start_state), dict(cnf._num_steps)) for cnf in cnfs]
+
+    def _evaluate():
+        for cnf in cnfs:
+            cnf._warm_start_state = {}
+            cnf._num_steps = {}
+        torch.manual_seed(seed)
+        return evaluate(model)
+
+    try:
+        return _calibrate(model, _evaluate, candidates, max_bpd_error, logger)
+    finally:
+        for cnf, (warm_start_state, num_steps) in zip(cnfs, saved):
+            cnf._warm_start_state = warm_start_state
+            cnf._num_steps = num_steps
+
+
+def _calibrate(model, _evaluate, candidates, max_bpd_error, logger):
+    config = get_cnf_config(model)
+    ref_bpd, best_nfe = _evaluate()
+    if logger is not None:
+        logger.info("Reference | bpd {:.5f} | NFE {:.0f}".format(ref_bpd, best_nfe))
+
+    for i in range(len(config)):
+        best = config[i]
+        for candidate in candidates:
+            trial = list(config)
+            trial[i] = dict(config[i], **candidate)
+            apply_cnf_config(model, trial)
+            try:
+                bpd, nfe = _evaluate()
+            except (AssertionError, RuntimeError) as e:
+                # e.g. underflow in dt of an adaptive solver that is too loose for this block.
+                if logger is not None:
+                    logger.info("Block {:d} | {} | failed: {}".format(i, candidate, e))
+                continue
+            if logger is not None:
+                logger.info("Block {:d} | {} | bpd {:.5f} | NFE {:.0f}".format(i, candidate, bpd, nfe))
+            if abs(bpd - ref_bpd) <= max_bpd_error and nfe < best_nfe:
+                best, best_nfe = trial[i], nfe
+        config[i] = best
+        apply_cnf_config(model, config)
+
+    return config, ref_bpd
+
+
+def override_divergence_fn(model, divergence_fn, **divergence_kwargs):
+    """Swaps the divergence estimator of every ODEfunc.
+
+    Extra keyword arguments are bound to the estimator, e.g. chunk_size, max_basis_bytes and
+    create_graph for "exact".
+    """
 
     def _set(module):
         if isinstance(module, layers.ODEfunc):
@@ -58,6 +259,14 @@ def override_divergence_fn(model, divergence_fn):
                 module.divergence_fn = divergence_bf
             elif divergence_fn == "approximate":
                 module.divergence_fn = divergence_approx
+            elif divergence_fn == "exact":
+                module.divergence_fn = functools.partial(divergence_exact, **divergence_kwargs)
+            elif divergence_fn == "hutchpp":
+                module.divergence_fn = divergence_hutchpp
+            elif divergence_fn == "hutchpp_cv":
+                module.divergence_fn = divergence_hutchpp_cv
+            if divergence_fn in ("hutchpp", "hutchpp_cv"):
+                _check_hutchpp_budget(module.div_samples)
 
     model.apply(_set)
 
@@ -99,6 +308,67 @@ def count_total_time(model):
 
 
 
+SOLVER_STATS_COUNTS = ("nfe_forward", "nfe_adjoint", "accepted", "rejected", "accepted_adjoint", "rejected_adjoint")
+
+
+def count_solver_stats(model):
+    """Sums the solver statistics of the latest iteration over the CNF blocks of every ODENVP scale.
+
+    Returns one dict per scale (a single one for models without scales) with the step and NFE
+    counts, the accepted step sizes binned per decade, the smallest final time reached and the
+    wall time per forward function evaluation.
+    """
+    model = getattr(model, 'module', model)
+    scales = list(model.transforms) if hasattr(model, 'transforms') else [model]
+
+    all_stats = []
+    for scale in scales:
+        stats = dict.fromkeys(SOLVER_STATS_COUNTS, 0)
+        step_sizes, final_t, solve_time = [], [], None
+        for module in scale.modules():
+            if isinstance(module, layers.CNF):
+                block_stats = module.solver_stats()
+                for key in SOLVER_STATS_COUNTS:
+                    stats[key] += block_stats[key]
+                step_sizes += block_stats["step_sizes"]
+                if block_stats["final_t"] is not None:
+                    final_t.append(abs(block_stats["final_t"]))
+                if block_stats["time_per_eval"] is not None:
+                    solve_time = (solve_time or 0.) + block_stats["time_per_eval"] * block_stats["nfe_forward"]
+        stats["step_hist"] = _decade_histogram(step_sizes)
+        stats["step_min"] = min(step_sizes) if step_sizes else None
+        stats["step_max"] = max(step_sizes) if step_sizes else None
+        stats["final_t"] = min(final_t) if final_t else None
+        stats["time_per_eval"] = solve_time / stats["nfe_forward"] if solve_time and stats["nfe_forward"] else None
+        all_stats.append(stats)
+    return all_stats
+
+
+def _decade_histogram(values, low=-4, high=1):
+    """Counts of values in [10^k, 10^(k+1)) for k in [low, high), clamped at both ends."""
+    counts = [0] * (high - low)
+    for v in values:
+        k = int(math.floor(math.log10(v))) if v > 0 else low
+        counts[min(max(k, low), high - 1) - low] += 1
+    return counts
+
+
+def format_solver_stats(all_stats):
+    messages = []
+    for i, stats in enumerate(all_stats):
+        message = "Scale {} | NFE {:.0f}+{:.0f} | Steps {}/{} rej | Adj Steps {}/{} rej".format(
+            i, stats["nfe_forward"], stats["nfe_adjoint"], stats["accepted"], stats["rejected"],
+            stats["accepted_adjoint"], stats["rejected_adjoint"])
+        if stats["step_min"] is not None:
+            message += " | h [{:.1e}, {:.1e}] {}".format(stats["step_min"], stats["step_max"], stats["step_hist"])
+        if stats["final_t"] is not None:
+            message += " | T {:.3f}".format(stats["final_t"])
+        if stats["time_per_eval"] is not None:
+            message += " | ms/FE {:.2f}".format(1000 * stats["time_per_eval"])
+        messages.append(message)
+    return "\n".join(messages)
+
+
 REGULARIZATION_FNS = {
     "kinetic_energy": reg_lib.quadratic_cost,
     "jacobian_norm2": reg_lib.jacobian_frobenius_regularization_fn,
@@ -125,6 +395,27 @@ def append_regularization_csv_dict(d, regularization_fns, reg_states):
     return d
 
 
+def ensure_csv_header(path, columns):
+    """Makes path a CSV log with the given columns, ready to be appended to with csv.DictWriter.
+
+    A log with another header, e.g. one written before a column was added, is moved aside to
+    <name>.<n>.csv instead of having misaligned rows appended to it.
+    """
+    if os.path.exists(path):
+        with open(path) as f:
+            header = next(csv.reader(f), None)
+        if header == list(columns):
+            return
+        if header is not None:
+            root, ext = os.path.splitext(path)
+            n = 1
+            while os.path.exists('{}.{}{}'.format(root, n, ext)):
+                n += 1
+            os.rename(path, '{}.{}{}'.format(root, n, ext))
+    with open(path, 'w') as f:
+        csv.DictWriter(f, columns).writeheader()
+
+
 def create_regularization_fns(args):
     regularization_fns = []
     regularization_coeffs = []
@@ -153,3 +444,36 @@ def get_regularization(model, regularization_coeffs):
     return acc_reg_states
 
 
+def get_test_set(train_args, datadir):
+    """Test split of the dataset a checkpoint was trained on, as [0, 1] images at its training resolution."""
+    if train_args.data == "mnist":
+        im_size = 28 if train_args.imagesize is None else train_args.imagesize
+        return dset.MNIST(root=datadir, train=False, transform=tforms.Compose([
+            tforms.Resize(im_size), tforms.ToTensor()]), download=True)
+    elif train_args.data == "celebahq":
+        im_size = 256 if train_args.imagesize is None else train_args.imagesize
+        return CelebAHQ(train=False, root=datadir, transform=tforms.Compose([
+            tforms.ToPILImage(), tforms.Resize(im_size), tforms.ToTensor()]))
+    raise ValueError("Unsupported dataset {}".format(train_args.data))
+
+
+def create_model_from_args(train_args, batch_size, data_shape, divergence_fn=None, div_samples=None):
+    """Rebuilds the ODENVP of a checkpoint from its arguments, optionally with another divergence estimator."""
+    regularization_fns, _ = create_regularization_fns(train_args)
+    model = odenvp.ODENVP(
+        (batch_size, *data_shape),
+        n_blocks=train_args.num_blocks,
+        intermediate_dims=tuple(map(int, train_args.dims.split(","))),
+        div_samples=train_args.div_samples if div_samples is None else div_samples,
+        divergence_fn=getattr(train_args, "divergence_fn", "approximate") if divergence_fn is None else divergence_fn,
+        strides=tuple(map(int, train_args.strides.split(","))),
+        squeeze_first=train_args.squeeze_first,
+        nonlinearity=train_args.nonlinearity,
+        layer_type=train_args.layer_type,
+        zero_last=train_args.zero_last,
+        alpha=train_args.alpha,
+        cnf_kwargs={"T": train_args.time_length, "train_T": train_args.train_T,
+                    "regularization_fns": regularization_fns},
+    )
+    set_cnf_options(train_args, model)
+    return model
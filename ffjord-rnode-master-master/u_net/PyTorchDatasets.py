@@ -1,6 +1,7 @@
 
 from PIL import Image
 import os
+from multiprocessing import Pool
 #import pickle
 import torch
 import random
@@ -13,9 +14,80 @@ import numpy as np
 from matplotlib import pyplot as plt
 
 
+def _decode(args):
+    image_path, resolution = args
+    img = Image.open(image_path).convert('RGB')
+    img = transforms.CenterCrop(resolution)(transforms.Resize(resolution)(img))
+    return np.asarray(img, dtype=np.uint8).transpose(2, 0, 1)
+
+
+def build_image_cache(image_paths, resolution, path, num_workers=8):
+    """Decodes, resizes and center-crops the images once into a uint8 (N, 3, resolution, resolution) .npy file."""
+    tmp = path + '.tmp'
+    shape = (len(image_paths), 3, resolution, resolution)
+    images = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.uint8, shape=shape)
+    with Pool(num_workers) as pool:
+        tasks = [(image_path, resolution) for image_path in image_paths]
+        for i, img in enumerate(pool.imap(_decode, tasks, chunksize=64)):
+            images[i] = img
+    images.flush()
+    del images
+    os.replace(tmp, path)
+
+
+def open_image_cache(cache_dir, name, image_paths, resolution):
+    """Memory-maps the cache of a dataset at the given resolution, building it first if needed."""
+    path = os.path.join(cache_dir, '{}_{}.npy'.format(name, resolution))
+    if os.path.exists(path):
+        images = np.load(path, mmap_mode='r')
+        if images.shape == (len(image_paths), 3, resolution, resolution):
+            return images
+    print("building image cache:", path)
+    os.makedirs(cache_dir, exist_ok=True)
+    build_image_cache(image_paths, resolution, path)
+    return np.load(path, mmap_mode='r')
+
+
+def _fixed_transform(imsize):
+    return transforms.Compose(
+            [ transforms.Resize(imsize),
+                transforms.CenterCrop(imsize),
+                #transforms.RandomHorizontalFlip(),
+                #transforms.ColorJitter(brightness=0.01, contrast=0.01, saturation=0.01, hue=0.01),
+                transforms.ToTensor(),
+                transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
+            ])
+
+
+def _default_device():
+    return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def _cached_fixed_batch(dataset, device):
+    """The dataset's fixed batch as one tensor on device, rebuilt only when dataset.imsize or device changes."""
+    device = _default_device() if device is None else torch.device(device)
+    key = (dataset.imsize, device)
+    if dataset._fixed_batch_key != key:
+        if dataset._fixed_batch_key is not None and dataset._fixed_batch_key[0] != dataset.imsize:
+            dataset.fixed_transform = _fixed_transform(dataset.imsize)
+        dataset._fixed_batch = None
+        batch = torch.stack([dataset.random_batch(idx, True)[0] for idx in dataset.fixed_indices])
+        dataset._fixed_batch = batch.to(device)
+        dataset._fixed_batch_key = key
+    return dataset._fixed_batch
+
+
+def _from_cache(images, index, flip):
+    # Same as ToTensor and Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)) on the decoded, cropped image.
+    img = torch.from_numpy(np.array(images[index]))
+    if flip and random.random() < 0.5:
+        img = img.flip(2)
+    return img.float().div_(127.5).sub_(1)
+
+
 class FFHQ(VisionDataset):
 
-    def __init__(self, root, transform, batch_size = 60, test_mode = False, return_all = False, imsize=256):
+    def __init__(self, root, transform, batch_size = 60, test_mode = False, return_all = False, imsize=256, cache_dir=None):
 
         self.root = root
         self.transform = transform
@@ -25,14 +97,17 @@ class FFHQ(VisionDataset):
         all_folders = os.listdir(self.root)
 
         self.length = sum([len(os.listdir(os.path.join(self.root,folder))) for folder in all_folders]) # = 70000
-        self.fixed_transform = transforms.Compose(
-                [ transforms.Resize(imsize),
-                    transforms.CenterCrop(imsize),
-                    #transforms.RandomHorizontalFlip(),
-                    #transforms.ColorJitter(brightness=0.01, contrast=0.01, saturation=0.01, hue=0.01),
-                    transforms.ToTensor(),
-                    transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
-                ])
+        # With a cache, samples are served pre-cropped at imsize and only flipped and normalized; transform
+        # is not applied.
+        self.images = None
+        if cache_dir is not None:
+            self.images = open_image_cache(
+                cache_dir, "ffhq", [self.image_path(index) for index in range(self.length)], imsize
+            )
+        self.imsize = imsize
+        self.fixed_transform = _fixed_transform(imsize)
+        self._fixed_batch = None
+        self._fixed_batch_key = None
 
         self.fixed_indices = []
 
@@ -44,17 +119,23 @@ class FFHQ(VisionDataset):
         return self.length
 
 
-    def fixed_batch(self, random = False):
+    def fixed_batch(self, random = False, device=None):
         if random == False:
-            return torch.stack([self.random_batch(idx, True)[0].cuda() for idx in self.fixed_indices])
+            return _cached_fixed_batch(self, device)
         else:
-            return torch.stack([self.random_batch(np.random.randint(self.length), True)[0].cuda() for _ in range(len(self.fixed_indices))])
-
-    def random_batch(self,index, fixed=False):
+            device = _default_device() if device is None else device
+            return torch.stack([self.random_batch(np.random.randint(self.length), True)[0] for _ in range(len(self.fixed_indices))]).to(device)
 
+    def image_path(self, index):
         folder = str(int(np.floor(index/1000)*1000)).zfill(5)
         file = str(index).zfill(5) + ".png"
-        image_path = os.path.join(self.root, folder , file )
+        return os.path.join(self.root, folder , file )
+
+    def random_batch(self,index, fixed=False):
+
+        image_path = self.image_path(index)
+        if self.images is not None and self.images.shape[-1] == self.imsize:
+            return _from_cache(self.images, index, not fixed), torch.zeros(1).long(), image_path
         img = Image.open( image_path).convert('RGB')
         if fixed:
             img = self.fixed_transform(img)
@@ -74,7 +155,7 @@ class FFHQ(VisionDataset):
 
 class Celeba(VisionDataset):
 
-    def __init__(self, root, transform, batch_size = 60, test_mode = False, return_all = False, imsize=128):
+    def __init__(self, root, transform, batch_size = 60, test_mode = False, return_all = False, imsize=128, cache_dir=None):
 
         self.root = root
         
@@ -85,14 +166,17 @@ class Celeba(VisionDataset):
         #for i in range(1,202600): #
         #    all_files.append(str(i).zfill(6) + '.png')
         self.length = len(self.all_files)
-        self.fixed_transform = transforms.Compose(
-                [ transforms.Resize(imsize),
-                    transforms.CenterCrop(imsize),
-                    #transforms.RandomHorizontalFlip(),
-                    #transforms.ColorJitter(brightness=0.01, contrast=0.01, saturation=0.01, hue=0.01),
-                    transforms.ToTensor(),
-                    transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
-                ])
+        # With a cache, samples are served pre-cropped at imsize and only flipped and normalized; transform
+        # is not applied.
+        self.images = None
+        if cache_dir is not None:
+            self.images = open_image_cache(
+                cache_dir, "celeba", [self.image_path(index) for index in range(self.length)], imsize
+            )
+        self.imsize = imsize
+        self.fixed_transform = _fixed_transform(imsize)
+        self._fixed_batch = None
+        self._fixed_batch_key = None
 
         self.fixed_indices = []
 
@@ -106,15 +190,20 @@ class Celeba(VisionDataset):
         return self.length
 
 
-    def fixed_batch(self):
-        return torch.stack([self.random_batch(idx, True)[0].cuda() for idx in self.fixed_indices])
-
+    def fixed_batch(self, device=None):
+        return _cached_fixed_batch(self, device)
 
-    def random_batch(self,index, fixed=False):
 
+    def image_path(self, index):
         file = str(index+1).zfill(6) + '.png'
         #file = self.all_files[index+1]
-        image_path = os.path.join(self.root, file )
+        return os.path.join(self.root, file )
+
+    def random_batch(self,index, fixed=False):
+
+        image_path = self.image_path(index)
+        if self.images is not None and self.images.shape[-1] == self.imsize:
+            return _from_cache(self.images, index, not fixed), torch.zeros(1).long(), image_path
         img = Image.open( image_path).convert('RGB')
         if fixed:
             img = self.fixed_transform(img)
@@ -34,6 +34,8 @@ def prepare_parser():
   usage = 'Parser for all scripts.'
   parser = ArgumentParser(description=usage)
   parser.add_argument("--data_folder", type=str)
+  parser.add_argument("--image_cache", type=str, default="",
+                      help="folder for a pre-decoded, pre-resized uint8 copy of the dataset (built on first use)")
   parser.add_argument("--warmup_epochs", type = float, default = 20)
 
   parser.add_argument("--id",type=str, default="")
@@ -19,6 +19,7 @@ import lib.odenvp as odenvp
 
 from train_misc import standard_normal_logprob
 from train_misc import set_cnf_options, count_nfe, count_parameters, count_total_time
+from train_misc import override_divergence_fn, apply_cnf_config, load_cnf_config
 from train_misc import create_regularization_fns, get_regularization, append_regularization_to_log
 from train_misc import append_regularization_keys_header, append_regularization_csv_dict
 
@@ -38,13 +39,23 @@ parser.add_argument(
     "--layer_type", type=str, default="concat",
     choices=["ignore", "concat", "concat_v2", "squash", "concatsquash", "concatcoord", "hyper", "blend", "spectral"]
 )
-parser.add_argument("--divergence_fn", type=str, default="approximate", choices=["brute_force", "approximate"])
+parser.add_argument(
+    "--divergence_fn", type=str, default="approximate",
+    choices=["brute_force", "approximate", "exact", "hutchpp", "hutchpp_cv"]
+)
+parser.add_argument('--div_chunk_size', type=int, default=None, help='basis vectors per batched VJP for exact divergence')
+parser.add_argument('--div_max_basis_mb', type=float, default=256,
+                    help='size cap of the basis vectors and products per chunk for exact divergence (not of activations)')
 parser.add_argument(
     "--nonlinearity", type=str, default="softplus", choices=["tanh", "relu", "softplus", "elu"]
 )
 parser.add_argument('--solver', type=str, default='dopri5', choices=SOLVERS)
 parser.add_argument('--atol', type=float, default=1e-5, help='only for adaptive solvers')
 parser.add_argument('--rtol', type=float, default=1e-5,  help='only for adaptive solvers')
+parser.add_argument('--error_control', type=str, default='z_logp', choices=['z_logp', 'z'],
+                    help='state tensors under adaptive step control, the reg states never are')
+parser.add_argument('--logp_atol', type=float, default=None, help='atol of logp, defaults to --atol')
+parser.add_argument('--logp_rtol', type=float, default=None, help='rtol of logp, defaults to --rtol')
 parser.add_argument('--step_size', type=float, default=0.25, help='only for fixed step size solvers')
 parser.add_argument('--first_step', type=float, default=0.25, help='only for adaptive solvers')
 
@@ -53,6 +64,7 @@ parser.add_argument('--test_atol', type=float, default=None)
 parser.add_argument('--test_rtol', type=float, default=None)
 parser.add_argument('--test_step_size', type=float, default=None)
 parser.add_argument('--test_first_step', type=float, default=None)
+parser.add_argument('--cnf_config', type=str, default=None, help='per-block test solver settings from calibrate_solver.py')
 
 parser.add_argument("--imagesize", type=int, default=None)
 parser.add_argument('--nbits', type=int, default=8)
@@ -164,6 +176,7 @@ def create_model(args, data_shape, regularization_fns):
         n_blocks=args.num_blocks,
         intermediate_dims=hidden_dims,
         div_samples=args.div_samples,
+        divergence_fn=args.divergence_fn,
         strides=strides,
         squeeze_first=args.squeeze_first,
         nonlinearity=args.nonlinearity,
@@ -190,6 +203,11 @@ if __name__ == "__main__":
     regularization_fns, regularization_coeffs = create_regularization_fns(args)
     model = create_model(args, data_shape, regularization_fns)
     set_cnf_options(args, model)
+    if args.cnf_config is not None:
+        apply_cnf_config(model, load_cnf_config(args.cnf_config))
+    if args.divergence_fn == "exact":
+        override_divergence_fn(model, "exact", chunk_size=args.div_chunk_size,
+                               max_basis_bytes=int(args.div_max_basis_mb * 2**20), create_graph=False)
 
 
 
@@ -277,6 +295,6 @@ if __name__ == "__main__":
                 # visualize samples and density
                 fig_filename = os.path.join(chkdir, "generated-T%g.jpg"%t)
                 utils.makedirs(os.path.dirname(fig_filename))
-                generated_samples = model(t*fixed_z, reverse=True)
+                generated_samples = model(t*fixed_z, reverse=True, density=False)
                 x = unshift(generated_samples[0].view(-1, *data_shape), 8)
                 save_image(x, fig_filename, nrow=args.nrow)